@@ -3,25 +3,66 @@ import sys
 import json
 import logging
 import collections
+import hashlib
 import math
 import scipy.stats
 import pandas as pd
 import numpy as np
 import alhena.constants as constants
-from alhena.elasticsearch import initialize_es, load_dashboard_record, load_records as _load_records
+from alhena.elasticsearch import initialize_es, load_dashboard_record, load_records as _load_records, publish_version, discard_version, finish_index, delete_index
+from utils.versions import get_version_index
+from utils.checkpoint import read_checkpoint, write_checkpoint, delete_checkpoint
+from utils.dead_letter import check_dead_letters
 from scgenome.loaders.qc import load_qc_data
 
 logger = logging.getLogger('alhena_loading')
 
 chr_prefixed = {str(a): '0' + str(a) for a in range(1, 10)}
 
-def load_analysis(dashboard_id, directory, host, port):
+def load_analysis(dashboard_id, directory, host, port, version=None, keep_versions=constants.KEEP_VERSIONS, merge_segments=None, resume=False):
     logger.info("====================== " + dashboard_id)
-    load_data(directory, dashboard_id, host, port)
+
+    checkpoint_filename = os.path.join(directory, constants.CHECKPOINT_FILENAME)
+
+    # A resumed load goes on in the indices the interrupted one was writing to
+    checkpoint = read_checkpoint(checkpoint_filename) if resume else None
+    if checkpoint is not None and checkpoint["dashboard_id"] == dashboard_id:
+        logger.info(f"Resuming from checkpoint" + ("" if checkpoint["version"] is None else f", in version {checkpoint['version']}"))
+        version = checkpoint["version"]
+    else:
+        clear_checkpoint(checkpoint_filename, version, host, port)
+        checkpoint = {"dashboard_id": dashboard_id, "version": version, "tables": {}}
+
+    # A versioned load writes new indices, that replace the live ones once all are loaded
+    try:
+        load_data(directory, dashboard_id, host, port, version=version, merge_segments=merge_segments, checkpoint=checkpoint)
+    except Exception:
+        if version is not None and not os.path.exists(checkpoint_filename):
+            discard_version(dashboard_id, version, host, port)
+        elif version is not None:
+            logger.info(f"Keeping version {version} of {dashboard_id} to resume from its checkpoint")
+        raise
+
+    if version is not None:
+        publish_version(dashboard_id, version, host, port, keep_versions=keep_versions)
+
     load_dashboard_entry(directory, dashboard_id, host, port)
+    delete_checkpoint(checkpoint_filename)
     logger.info("Done")
 
-def load_data(directory, dashboard_id, host, port):
+
+def clear_checkpoint(checkpoint_filename, version, host, port):
+    # Indices of an interrupted versioned load are not going to be resumed
+    checkpoint = read_checkpoint(checkpoint_filename)
+
+    if checkpoint is not None and checkpoint["version"] is not None and checkpoint["version"] != version:
+        logger.info(f"Discarding version {checkpoint['version']} of {checkpoint['dashboard_id']} left by an interrupted load")
+        discard_version(checkpoint["dashboard_id"], checkpoint["version"], host, port)
+
+    delete_checkpoint(checkpoint_filename)
+
+
+def load_data(directory, dashboard_id, host, port, version=None, merge_segments=None, checkpoint=None):
     logger.info("LOADING DATA: " + dashboard_id)
 
     hmmcopy_data = collections.defaultdict(list)
@@ -35,13 +76,48 @@ def load_data(directory, dashboard_id, host, port):
     logger.info(f'loading hmmcopy data with tables {hmmcopy_data.keys()}')
 
     for index_type in constants.DATA_TYPES:
-        index_name = f"{dashboard_id.lower()}_{index_type}"
+        index_name = get_version_index(f"{dashboard_id.lower()}_{index_type}", version)
         logger.info(f"Index {index_name}")
 
         data = eval(f"get_{index_type}_data(hmmcopy_data)")
 
         logger.info(f"dataframe for {index_name} has shape {data.shape}")
-        load_records(data, index_name, host, port)
+
+        key = constants.DATA_KEYS[index_type]
+        if data.duplicated(subset=key).any():
+            raise ValueError(f"{index_name} has rows with the same {', '.join(key)}")
+
+        # Rows of the table indexed before the load was interrupted
+        start = 0
+        if checkpoint is not None:
+            table = {"fingerprint": get_fingerprint(data), "num_records": 0}
+            previous = checkpoint["tables"].get(index_type)
+
+            if previous is not None and previous["fingerprint"] == table["fingerprint"]:
+                table = previous
+                start = table["num_records"]
+                logger.info(f"Resuming {index_name} after {start} records")
+            elif previous is not None:
+                logger.info(f"{index_name} changed since the checkpoint, loading it from the start")
+                delete_index(index_name, host=host, port=port)
+
+            checkpoint["tables"][index_type] = table
+
+        def save_checkpoint(num_records):
+            if checkpoint is not None:
+                # A resumed load would skip rows that failed to index
+                check_dead_letters([index_name])
+
+                checkpoint["tables"][index_type]["num_records"] = num_records
+                write_checkpoint(os.path.join(directory, constants.CHECKPOINT_FILENAME), checkpoint)
+
+        load_records(data, index_name, host, port, key, start=start, on_batch=save_checkpoint)
+        finish_index(index_name, host, port, max_num_segments=merge_segments)
+
+
+def get_fingerprint(data):
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values.tobytes()).hexdigest()[:16]
+
 
 def get_qc_data(hmmcopy_data):
     data = hmmcopy_data['annotation_metrics']
@@ -92,13 +168,13 @@ GET_DATA = {
 
 
 
-def load_records(data, index_name, host, port):
-
+def load_records(data, index_name, host, port, key, start=0, on_batch=None):
+    # Document ids are the key fields of the rows, so rows sent again (retried or resumed) replace their documents
     total_records = data.shape[0]
-    num_records = 0
+    num_records = start
 
     batch_size = int(1e5)
-    for batch_start_idx in range(0, data.shape[0], batch_size):
+    for batch_start_idx in range(start, data.shape[0], batch_size):
         batch_end_idx = min(batch_start_idx + batch_size, data.shape[0])
         batch_data = data.loc[data.index[batch_start_idx:batch_end_idx]]
 
@@ -106,13 +182,17 @@ def load_records(data, index_name, host, port):
 
         records = []
         for record in batch_data.to_dict(orient='records'):
+            record["_id"] = ":".join(str(record[field]) for field in key)
             clean_nans(record)
             records.append(record)
 
-        _load_records(records, index_name, host, port)
+        _load_records(records, index_name, host, port, loading_settings=True)
         num_records += batch_data.shape[0]
         logger.info(f"Loading {len(records)} records. Total: {num_records} / {total_records} ({round(num_records * 100 / total_records, 2)}%)")
 
+        if on_batch is not None:
+            on_batch(num_records)
+
 
     if total_records != num_records:
         raise ValueError(f'mismatch in {num_cells} cells loaded to {total_cells} total cells')
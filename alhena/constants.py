@@ -1,4 +1,17 @@
 
 DASHBOARD_ENTRY_INDEX = "analyses"
 DATA_TYPES = ["qc", "segs", "bins", "gc_bias"]
-METADATA_FILENAME = "metadata.json"
\ No newline at end of file
+# Natural key of the rows of each data type, joined into their document ids
+DATA_KEYS = {
+    "qc": ["cell_id"],
+    "segs": ["cell_id", "chr", "start"],
+    "bins": ["cell_id", "chr", "start"],
+    "gc_bias": ["cell_id", "gc_percent"]
+}
+METADATA_FILENAME = "metadata.json"
+
+# Versions of reloaded indices kept, the live one included
+KEEP_VERSIONS = 2
+
+# Checkpoint of the last load, in the data directory
+CHECKPOINT_FILENAME = ".alhena_checkpoint.json"
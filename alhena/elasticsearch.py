@@ -1,5 +1,9 @@
-from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from utils.es_client import get_client
+from utils.pipeline import pipelined_bulk
+from utils.dead_letter import get_dead_letter_file, replay_dead_letters, check_dead_letters
+from utils.index_profile import get_loading_mapping, apply_serving_settings
+from utils.versions import get_version_index, swap_alias, remove_old_versions, delete_versions
 import alhena.constants as constants
 import os
 
@@ -37,34 +41,43 @@ DEFAULT_MAPPING = {
 def initialize_es(host, port):
     assert os.environ['ALHENA_ES_USER'] is not None and os.environ['ALHENA_ES_PASSWORD'] is not None, 'Elasticsearch credentials missing'
 
-    es = Elasticsearch(hosts=[{'host': host, 'port': port}], 
+    return get_client(host, port,
         http_auth=(os.environ['ALHENA_ES_USER'], os.environ['ALHENA_ES_PASSWORD']),
         scheme='https',
-        timeout=300, 
+        timeout=300,
         verify_certs=False)
-        
-    return es
 
 
 
 def load_dashboard_record(record, dashboard_id, host, port):
     load_record(record, dashboard_id, constants.DASHBOARD_ENTRY_INDEX, host, port)
 
-def load_records(records, index_name, host, port, mapping=DEFAULT_MAPPING):
+def load_records(records, index_name, host, port, mapping=DEFAULT_MAPPING, loading_settings=False):
     es = initialize_es(host, port)
 
     if not es.indices.exists(index_name):
-        logger.info(f'No index found - creating index named {index_name}')
+        logger.info(f'No index found - creating index named {index_name}' + (' with the loading settings' if loading_settings else ''))
         es.indices.create(
             index=index_name,
-            body=mapping
+            body=get_loading_mapping(mapping) if loading_settings else mapping
         )
     
-    for success, info in helpers.parallel_bulk(es, records, index=index_name):
-        if not success:
-            #   logging.error(info)
-            logger.info(info)
-            logger.info('Doc failed in parallel loading')
+    # Records are built, encoded and sent in overlapping stages, returns how many were indexed
+    return pipelined_bulk(es, records, index_name, dead_letter_file=get_dead_letter_file(), logger=logger)
+
+
+def replay_failed(filename, host, port):
+    # Sends the documents of a dead letter file again
+    es = initialize_es(host, port)
+
+    return replay_dead_letters(es, filename, lambda es, records, index_name: pipelined_bulk(es, records, index_name, dead_letter_file=get_dead_letter_file(), logger=logger), logger=logger)
+
+def finish_index(index_name, host, port, max_num_segments=None):
+    # Serving settings for an index loaded with the loading settings
+    es = initialize_es(host, port)
+
+    if es.indices.exists(index_name):
+        apply_serving_settings(es, index_name, max_num_segments=max_num_segments, logger=logger)
 
 def load_record(record, record_id, index, host, port, mapping=DEFAULT_MAPPING):
     es = initialize_es(host, port)
@@ -94,8 +107,36 @@ def clean_analysis(dashboard_id, host, port):
 
 
 
+def publish_version(dashboard_id, version, host, port, keep_versions=constants.KEEP_VERSIONS):
+    # Points the dashboard's indices to the ones loaded as version
+    es = initialize_es(host, port)
+
+    # Tables without rows have no index
+    indices = {alias: get_version_index(alias, version) for alias in [f"{dashboard_id.lower()}_{data_type}" for data_type in constants.DATA_TYPES]}
+    indices = {alias: index for alias, index in indices.items() if es.indices.exists(index)}
+
+    check_dead_letters(list(indices.values()))
+
+    for alias, index in indices.items():
+        es.indices.refresh(index)
+
+        logger.info(f"Pointing {alias} to {index}")
+        swap_alias(es, alias, index, logger=logger)
+        remove_old_versions(es, alias, keep_versions, logger=logger)
+
+
+def discard_version(dashboard_id, version, host, port):
+    # Indices of a failed versioned load, the live ones are untouched
+    for data_type in constants.DATA_TYPES:
+        delete_index(get_version_index(f"{dashboard_id.lower()}_{data_type}", version), host=host, port=port)
+
+
 def delete_index(index, host="localhost", port=9200):
     es = initialize_es(host, port)
+
+    # After versioned loads, index is an alias to its versions
+    delete_versions(es, index, logger=logger)
+
     if es.indices.exists(index):
         es.indices.delete(index=index, ignore=[400, 404])
 
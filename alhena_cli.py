@@ -2,10 +2,16 @@ import click
 import logging
 import logging.handlers
 import os
+import time
 
 from alhena.alhena_loader import load_analysis as _load_analysis
 from alhena.alhena_data import download_analysis as _download_analysis
-from alhena.elasticsearch import clean_analysis as _clean_analysis
+from alhena.elasticsearch import clean_analysis as _clean_analysis, replay_failed as _replay_failed
+from utils.versions import get_new_version
+from utils.dead_letter import set_dead_letter_file, log_dead_letter_summary
+from utils.es_client import set_http_compress
+from utils.ndjson import set_encode_processes
+import alhena.constants as constants
 
 
 LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
@@ -14,8 +20,11 @@ LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
 @click.option('--host', default='localhost', help='Hostname for Elasticsearch server')
 @click.option('--port', default=9200, help='Port for Elasticsearch server')
 @click.option('--debug', is_flag=True, help='Turn on debugging logs')
+@click.option('--dead-letter-file', help='Where to write documents that failed to index, defaults to a new file in logs/', default=None)
+@click.option('--http-compress', is_flag=True, help='Gzip bulk request bodies')
+@click.option('--encode-processes', help='Number of processes encoding bulk requests, 0 to encode in the loading process', type=int, default=0)
 @click.pass_context
-def main(ctx, host, port, debug):
+def main(ctx, host, port, debug, dead_letter_file, http_compress, encode_processes):
     ctx.obj['host'] = host
     ctx.obj['port'] = port
 
@@ -34,20 +43,28 @@ def main(ctx, host, port, debug):
 
     ctx.obj['logger'] = logger
 
+    ctx.obj['dead_letter_file'] = dead_letter_file if dead_letter_file is not None else time.strftime('logs/failed_documents_%Y-%m-%d_%H%M%S.ndjson')
+    set_dead_letter_file(ctx.obj['dead_letter_file'])
+
+    set_http_compress(http_compress)
+    set_encode_processes(encode_processes)
+
 
 @main.command()
 @click.argument('data_directory')
 @click.pass_context
 @click.option('--id', help="ID of dashboard", required=True)
-@click.option('--reload', is_flag=True, help="Force reload this dashboard")
-def load_analysis(ctx, data_directory, id, reload):
+@click.option('--reload', is_flag=True, help="Reload into new indices, that replace the live ones once loaded")
+@click.option('--keep-versions', help="Number of versions of reloaded indices to keep, the live one included", type=int, default=constants.KEEP_VERSIONS)
+@click.option('--merge-segments', help="Force merge loaded indices down to this many segments", type=int, default=None)
+@click.option('--resume', is_flag=True, help="Resume an interrupted load from its checkpoint")
+def load_analysis(ctx, data_directory, id, reload, keep_versions, merge_segments, resume):
     es_host = ctx.obj['host']
     es_port = ctx.obj["port"]
 
-    if reload:
-        _clean_analysis(id, host=es_host, port=es_port)
+    _load_analysis( id, data_directory, es_host, es_port, version=get_new_version() if reload else None, keep_versions=keep_versions, merge_segments=merge_segments, resume=resume)
 
-    _load_analysis( id, data_directory, es_host, es_port)
+    log_dead_letter_summary(logger=ctx.obj['logger'])
 
 
 @main.command()
@@ -58,18 +75,29 @@ def load_analysis(ctx, data_directory, id, reload):
 @click.option('--library_id')
 @click.option('--description')
 @click.option('--download', is_flag=True, help="Download data")
-@click.option('--reload', is_flag=True, help="Force reload this dashboard")
-def load_analysis_shah(ctx, data_directory, id, sample_id, library_id, description, download, reload):
+@click.option('--reload', is_flag=True, help="Reload into new indices, that replace the live ones once loaded")
+@click.option('--keep-versions', help="Number of versions of reloaded indices to keep, the live one included", type=int, default=constants.KEEP_VERSIONS)
+@click.option('--merge-segments', help="Force merge loaded indices down to this many segments", type=int, default=None)
+@click.option('--resume', is_flag=True, help="Resume an interrupted load from its checkpoint")
+def load_analysis_shah(ctx, data_directory, id, sample_id, library_id, description, download, reload, keep_versions, merge_segments, resume):
     es_host = ctx.obj['host']
     es_port = ctx.obj["port"]
     if download:
         data_directory = _download_analysis(id, data_directory, sample_id, library_id, description)
 
-    if reload:
-        _clean_analysis(id, host=es_host, port=es_port)
+    _load_analysis( id, data_directory, es_host, es_port, version=get_new_version() if reload else None, keep_versions=keep_versions, merge_segments=merge_segments, resume=resume)
+
+    log_dead_letter_summary(logger=ctx.obj['logger'])
+
 
-    _load_analysis( id, data_directory, es_host, es_port)
 
+@main.command()
+@click.argument('dead_letter_file')
+@click.pass_context
+def replay_failed(ctx, dead_letter_file):
+    _replay_failed(dead_letter_file, ctx.obj['host'], ctx.obj['port'])
+
+    log_dead_letter_summary(logger=ctx.obj['logger'])
 
 
 @main.command()
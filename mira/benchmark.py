@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+import itertools
+import pandas as pd
+
+from elasticsearch import helpers
+from mira.mira_loader import read_cells, read_genes, get_records
+from mira.cache import iter_cached_blocks
+from mira.elasticsearch import initialize_es, load_records, delete_index
+from utils.bulk_tuner import BulkTuner
+from utils.es_client import get_client
+from utils.index_profile import get_loading_mapping
+from utils.ndjson import set_encode_processes
+from utils.pipeline import pipelined_bulk
+import mira.constants as constants
+
+logger = logging.getLogger('mira_loading')
+
+
+## Index time and size of the nested and compact gene layouts of cell documents,
+## measured by loading the same cells into a scratch index per layout
+
+
+def benchmark_gene_layouts(directory, host, port, num_cells=5000, cache=True):
+    cells = read_cells(directory, cache=cache)
+    genes = read_genes(directory, cache=cache)
+
+    es = initialize_es(host, port)
+    results = []
+
+    for gene_layout in constants.GENE_LAYOUTS:
+        index_name = f'{constants.BENCHMARK_INDEX_PREFIX}{gene_layout}_{os.getpid()}'
+        mapping = constants.CELLS_COMPACT_INDEX_MAPPING if gene_layout == 'compact' else constants.CELLS_INDEX_MAPPING
+
+        delete_index(index_name, host=host, port=port)
+
+        records = list(itertools.islice(_iter_sample_records(directory, cells, genes, gene_layout, cache), num_cells))
+
+        try:
+            start = time.time()
+            load_records(records, index_name, mapping, host, port)
+            es.indices.refresh(index=index_name)
+            index_seconds = time.time() - start
+
+            # Merged down to one segment so sizes don't depend on when merges happened to run
+            start = time.time()
+            es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+            merge_seconds = time.time() - start
+
+            stats = es.indices.stats(index=index_name, metric='docs,store')['indices'][index_name]['primaries']
+        finally:
+            delete_index(index_name, host=host, port=port)
+
+        results.append({
+            "gene_layout": gene_layout,
+            "cells": len(records),
+            "lucene_docs": stats['docs']['count'],
+            "index_seconds": round(index_seconds, 2),
+            "merge_seconds": round(merge_seconds, 2),
+            "size_mb": round(stats['store']['size_in_bytes'] / 1024 ** 2, 2)
+        })
+
+        logger.info(f'{gene_layout}: {results[-1]}')
+
+    results = pd.DataFrame(results)
+    logger.info(f'Gene layout benchmark for {directory}:\n{results.to_string(index=False)}')
+
+    return results
+
+
+def _iter_sample_records(directory, cells, genes, gene_layout, cache):
+    matrix_filename = os.path.join(directory, constants.MATRIX_FILENAME)
+
+    for matrix_block in iter_cached_blocks(matrix_filename, int(1e6), cache=cache):
+        yield from get_records(cells, genes, matrix_block, gene_layout=gene_layout)
+
+
+## Bulk throughput of the previous path (parallel_bulk, encoded with the client's serializer in its threads)
+## against the pipelined path, encoding in threads or in processes, with and without gzipped bodies
+
+def benchmark_bulk_paths(directory, host, port, num_cells=5000, cache=True, encode_processes=4):
+    cells = read_cells(directory, cache=cache)
+    genes = read_genes(directory, cache=cache)
+
+    records = list(itertools.islice(_iter_sample_records(directory, cells, genes, 'nested', cache), num_cells))
+
+    paths = [
+        ("parallel_bulk", 0, False),
+        ("pipelined", 0, False),
+        ("pipelined", encode_processes, False),
+        ("pipelined", encode_processes, True)
+    ]
+
+    results = []
+    for path, num_processes, http_compress in paths:
+        es = get_client(host, port, retry_on_timeout=True, timeout=300, http_compress=http_compress)
+        index_name = f'{constants.BENCHMARK_INDEX_PREFIX}bulk_{os.getpid()}'
+
+        delete_index(index_name, host=host, port=port)
+        es.indices.create(index=index_name, body=get_loading_mapping(constants.CELLS_INDEX_MAPPING))
+
+        try:
+            start = time.time()
+            if path == "parallel_bulk":
+                for success, info in helpers.parallel_bulk(es, records, index=index_name, chunk_size=500, thread_count=4):
+                    if not success:
+                        logger.error(info)
+            else:
+                set_encode_processes(num_processes)
+                # A new tuner each time, so no path starts from what an earlier one learnt
+                pipelined_bulk(es, records, index_name, tuner=BulkTuner(logger=logger), logger=logger)
+            index_seconds = time.time() - start
+
+            es.indices.refresh(index=index_name)
+            num_docs = es.count(index=index_name)['count']
+        finally:
+            delete_index(index_name, host=host, port=port)
+
+        results.append({
+            "path": path,
+            "encode_processes": num_processes,
+            "http_compress": http_compress,
+            "cells": num_docs,
+            "index_seconds": round(index_seconds, 2),
+            "cells_per_second": round(num_docs / index_seconds)
+        })
+
+        logger.info(f'{path}: {results[-1]}')
+
+    set_encode_processes(0)
+
+    results = pd.DataFrame(results)
+    logger.info(f'Bulk path benchmark for {directory}:\n{results.to_string(index=False)}')
+
+    return results
@@ -0,0 +1,195 @@
+import logging
+import hashlib
+import numpy as np
+import pandas as pd
+
+import mira.constants as constants
+
+logger = logging.getLogger('mira_loading')
+
+
+## UMAP binning for dashboard_bins_* records
+## We assume 100 x 100 bins over the extent of the cells
+
+
+def get_bin_sizes(cells):
+    return [(cells['x'].max() - cells['x'].min()) / 100, (cells['y'].max() - cells['y'].min()) / 100]
+
+
+def get_categorical_bins(cells, labels, x_bin_size, y_bin_size):
+    # Same bins as a histogram aggregation on x and y with a size 1 terms aggregation on each label:
+    # count is the number of cells in the bin and value the most common label value,
+    # ties going to the smallest value
+    binned = pd.DataFrame({'x': np.floor(cells['x'] / x_bin_size), 'y': np.floor(cells['y'] / y_bin_size)})
+    has_bin = binned['x'].notna() & binned['y'].notna()
+
+    bin_counts = binned[has_bin].groupby(['x', 'y']).size().rename('count').reset_index()
+
+    records = []
+    for label in labels:
+        if label not in cells.columns:
+            logger.info(f'No {label} in cells, skipping')
+            continue
+
+        values = binned.assign(value=cells[label])
+        values = values[has_bin & values['value'].notna()]
+
+        value_counts = values.groupby(['x', 'y', 'value']).size().rename('value_count').reset_index()
+        value_counts = value_counts.sort_values(['x', 'y', 'value_count', 'value'], ascending=[True, True, False, True])
+
+        top_values = value_counts.drop_duplicates(['x', 'y']).merge(bin_counts)
+
+        for bin_record in top_values[['x', 'y', 'count', 'value']].to_dict(orient='records'):
+            records.append({
+                "x": int(bin_record['x']),
+                "y": int(bin_record['y']),
+                "count": bin_record['count'],
+                "label": label,
+                "value": bin_record['value']
+            })
+
+    return records
+
+
+class GeneBins():
+    # Sums log_count per (bin, gene), fed one matrix block at a time
+    # Sums are kept sparse, as sorted bin * num_genes + gene keys with their totals
+
+    def __init__(self, cells, genes, x_bin_size, y_bin_size):
+        self.x_bin_size = x_bin_size
+        self.y_bin_size = y_bin_size
+
+        cell_bins = pd.DataFrame({'x': cells['x'] // x_bin_size, 'y': cells['y'] // y_bin_size})
+        cell_bins = cell_bins.groupby(['x', 'y'])
+
+        self.bins = cell_bins.size()
+        self.gene_names = genes['gene'].to_list()
+        self.num_genes = len(self.gene_names)
+
+        # Bin code for each cell_idx, -1 if the cell has no coordinates
+        self.cell_bins = np.full(int(cells['cell_idx'].max()) + 1, -1, dtype=np.int64)
+        self.cell_bins[cells['cell_idx'].values] = cell_bins.ngroup().fillna(-1).astype(np.int64).values
+
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.pending = []
+        self.num_pending = 0
+
+        logger.info(f'Bins: {self.bins.shape[0]}')
+
+    def add(self, matrix):
+        bin_codes = self.cell_bins[np.repeat(matrix.cell_idx, np.diff(matrix.indptr))]
+        has_bin = bin_codes >= 0
+
+        keys = bin_codes[has_bin] * self.num_genes + (matrix.gene_idx[has_bin] - 1)
+        self.add_sums(*_sum_keys(keys, matrix.log_count[has_bin]))
+
+    def add_sums(self, keys, sums):
+        # Sums from another accumulator over the same bins and genes
+        self.pending.append((keys, sums))
+        self.num_pending += keys.shape[0]
+
+        # Merging costs the size of the accumulator, so only do it once enough has piled up
+        if self.num_pending > max(self.keys.shape[0], int(1e7)):
+            self._merge()
+
+    def _merge(self):
+        if len(self.pending) == 0:
+            return
+
+        keys = np.concatenate([self.keys] + [keys for keys, _ in self.pending])
+        sums = np.concatenate([self.sums] + [sums for _, sums in self.pending])
+
+        [self.keys, self.sums] = _sum_keys(keys, sums)
+        self.pending = []
+        self.num_pending = 0
+
+    def get_sums(self):
+        self._merge()
+
+        return self.keys, self.sums
+
+    def get_records(self, sparse=False, bins=None):
+        # Dense writes every bin x gene, sparse only non-zero genes plus a total count document per bin
+        # bins limits the records to those (x, y) bins
+        self._merge()
+
+        bin_codes = self.keys // self.num_genes
+        gene_codes = self.keys % self.num_genes
+        bounds = np.searchsorted(bin_codes, np.arange(self.bins.shape[0] + 1))
+
+        for code, [[x, y], total_count] in enumerate(self.bins.items()):
+            if bins is not None and (float(x), float(y)) not in bins:
+                continue
+
+            [start, end] = [bounds[code], bounds[code + 1]]
+
+            x = float(x)
+            y = float(y)
+            total_count = int(total_count)
+
+            bin_values = zip(gene_codes[start:end].tolist(), (self.sums[start:end] / total_count).tolist())
+
+            if sparse:
+                yield {
+                    'x': x,
+                    'y': y,
+                    'count': total_count,
+                    'label': constants.BIN_TOTAL_LABEL,
+                    'value': total_count
+                }
+
+                yield from ({
+                    'x': x,
+                    'y': y,
+                    'count': total_count,
+                    'label': self.gene_names[gene_code],
+                    'value': value
+                } for gene_code, value in bin_values if value != 0)
+
+                continue
+
+            values = [0] * self.num_genes
+            for gene_code, value in bin_values:
+                values[gene_code] = value
+
+            yield from ({
+                'x': x,
+                'y': y,
+                'count': total_count,
+                'label': gene,
+                'value': value
+            } for gene, value in zip(self.gene_names, values))
+
+    def get_bin_hashes(self):
+        # Hash of the gene sums and count of each (x, y) bin, to find bins that changed since a previous load
+        self._merge()
+
+        bin_codes = self.keys // self.num_genes
+        bounds = np.searchsorted(bin_codes, np.arange(self.bins.shape[0] + 1))
+        genes_hash = hashlib.blake2b('\t'.join(self.gene_names).encode(), digest_size=8).digest()
+
+        hashes = {}
+        for code, [[x, y], total_count] in enumerate(self.bins.items()):
+            [start, end] = [bounds[code], bounds[code + 1]]
+
+            bin_hash = hashlib.blake2b(genes_hash, digest_size=8)
+            bin_hash.update(f'{int(total_count)}'.encode())
+            bin_hash.update((self.keys[start:end] % self.num_genes).tobytes())
+            bin_hash.update(self.sums[start:end].tobytes())
+
+            hashes[(float(x), float(y))] = bin_hash.hexdigest()
+
+        return hashes
+
+    def get_num_zero_records(self):
+        # Gene records a sparse load leaves out
+        self._merge()
+
+        return self.bins.shape[0] * self.num_genes - int(np.count_nonzero(self.sums))
+
+
+def _sum_keys(keys, weights):
+    keys, inverse = np.unique(keys, return_inverse=True)
+
+    return keys, np.bincount(inverse, weights=weights, minlength=keys.shape[0])
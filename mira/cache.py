@@ -0,0 +1,336 @@
+import logging
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+from mira.matrix import CellMatrix, CellIndex, NotGroupedError, read_matrix, iter_cell_blocks, build_cell_index
+from mira.external_sort import sort_matrix
+import mira.constants as constants
+
+logger = logging.getLogger('mira_loading')
+
+
+## Binary sidecar cache of parsed input files
+## Entries live in a cache directory next to the (symlink-resolved) source file, one directory per
+## source file version, named <filename>-<fingerprint>. The matrix is stored as .npy arrays in
+## cell-major layout and memory-mapped on load, tables are pickled DataFrames.
+## Matrix entries keep cells in the order the matrix streams in (file order if it is grouped by cell,
+## cell_idx order if it has to be sorted), whichever reader writes them, so checkpoints of streamed loads count
+## the same cells with or without the cache.
+
+MATRIX_ARRAYS = ['cell_idx', 'indptr', 'gene_idx', 'log_count']
+CELL_INDEX_ARRAYS = ['cell_idx', 'rows', 'offsets']
+
+
+def get_fingerprint(filename):
+    # Size, mtime and a hash of the first and last blocks of the file
+    stat = os.stat(filename)
+
+    file_hash = hashlib.sha1()
+    file_hash.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+    with open(filename, 'rb') as source_file:
+        file_hash.update(source_file.read(constants.CACHE_HASH_BLOCK_SIZE))
+
+        if stat.st_size > 2 * constants.CACHE_HASH_BLOCK_SIZE:
+            source_file.seek(-constants.CACHE_HASH_BLOCK_SIZE, os.SEEK_END)
+            file_hash.update(source_file.read(constants.CACHE_HASH_BLOCK_SIZE))
+
+    return file_hash.hexdigest()[:16]
+
+
+def get_entry_directory(filename, kind=None):
+    # kind tells apart several entries derived from the same source file
+    filename = os.path.realpath(filename)
+    cache_directory = os.path.join(os.path.dirname(filename), constants.CACHE_DIRECTORY)
+    entry_name = os.path.basename(filename) if kind is None else os.path.basename(filename) + '.' + kind
+
+    return os.path.join(cache_directory, entry_name + '-' + get_fingerprint(filename))
+
+
+def _open_entry(entry_directory):
+    metadata_filename = os.path.join(entry_directory, constants.CACHE_METADATA_FILENAME)
+
+    if not os.path.exists(metadata_filename):
+        return None
+
+    with open(metadata_filename) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    # Mark as recently used for eviction, which read-only cache directories can't be
+    try:
+        os.utime(metadata_filename)
+    except OSError as error:
+        logger.debug(f'Cannot mark {entry_directory} as used: {error}')
+
+    return metadata
+
+
+def is_cache_entry(entry_directory):
+    return os.path.exists(os.path.join(entry_directory, constants.CACHE_METADATA_FILENAME))
+
+
+def _create_entry(entry_directory):
+    # Entries are written to a temporary directory and renamed into place once complete.
+    # Returns None if the cache directory can't be written to (read-only data), to go on without the cache
+    try:
+        _remove_stale_entries(entry_directory)
+
+        temp_directory = entry_directory + '.tmp'
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        os.makedirs(temp_directory)
+    except OSError as error:
+        logger.warning(f'Cannot write cache entry {entry_directory} ({error}), reading without the cache')
+        return None
+
+    return temp_directory
+
+
+def _commit_entry(temp_directory, entry_directory, metadata):
+    with open(os.path.join(temp_directory, constants.CACHE_METADATA_FILENAME), 'w+') as metadata_file:
+        json.dump({**metadata, 'created': time.time()}, metadata_file)
+
+    os.rename(temp_directory, entry_directory)
+    logger.info(f'Cached {metadata["source"]} at {entry_directory}')
+
+
+def _remove_stale_entries(entry_directory):
+    # Any other version of the same source file is out of date
+    [cache_directory, entry_name] = os.path.split(entry_directory)
+    source_name = entry_name.rsplit('-', 1)[0]
+
+    if not os.path.exists(cache_directory):
+        return
+
+    for name in os.listdir(cache_directory):
+        # Entries other processes are writing are theirs to commit or remove
+        if name.endswith('.tmp'):
+            continue
+
+        if name != entry_name and name.rsplit('-', 1)[0] == source_name:
+            logger.info(f'Removing stale cache entry {name}')
+            shutil.rmtree(os.path.join(cache_directory, name), ignore_errors=True)
+
+
+def read_table(filename, cache=True):
+    if not cache:
+        return pd.read_csv(filename, sep='\t')
+
+    entry_directory = get_entry_directory(filename)
+    table_filename = os.path.join(entry_directory, 'table.pkl')
+
+    if _open_entry(entry_directory) is not None:
+        logger.debug(f'Reading {filename} from cache')
+        return pd.read_pickle(table_filename)
+
+    table = pd.read_csv(filename, sep='\t')
+
+    temp_directory = _create_entry(entry_directory)
+    if temp_directory is None:
+        return table
+
+    table.to_pickle(os.path.join(temp_directory, 'table.pkl'))
+    _commit_entry(temp_directory, entry_directory, {'source': os.path.realpath(filename)})
+
+    return table
+
+
+def get_cache_entry(filename):
+    # Entry directory for the current version of filename, None if it is not cached
+    entry_directory = get_entry_directory(filename)
+
+    return entry_directory if _open_entry(entry_directory) is not None else None
+
+
+def load_matrix(entry_directory):
+    return CellMatrix(*[np.load(os.path.join(entry_directory, name + '.npy'), mmap_mode='r') for name in MATRIX_ARRAYS])
+
+
+def read_cached_matrix(filename, cache=True, sort_memory=constants.SORT_MEMORY_LIMIT):
+    if not cache:
+        return read_matrix(filename)
+
+    entry_directory = get_entry_directory(filename)
+
+    if _open_entry(entry_directory) is not None:
+        logger.info(f'Reading {filename} from cache')
+        return load_matrix(entry_directory)
+
+    # The entry is written by streaming the matrix, in the same order of cells as streamed loads
+    for _ in iter_cached_blocks(filename, constants.CACHE_BLOCK_SIZE, cache=cache, sort_memory=sort_memory):
+        pass
+
+    if _open_entry(entry_directory) is None:
+        return read_matrix(filename)
+
+    return load_matrix(entry_directory)
+
+
+def get_cell_index(filename, cache=True):
+    if not cache:
+        return build_cell_index(filename)
+
+    entry_directory = get_entry_directory(filename, kind='cells')
+
+    if _open_entry(entry_directory) is not None:
+        logger.info(f'Reading cell index of {filename} from cache')
+        return CellIndex(*[np.load(os.path.join(entry_directory, name + '.npy')) for name in CELL_INDEX_ARRAYS])
+
+    cell_index = build_cell_index(filename)
+
+    temp_directory = _create_entry(entry_directory)
+    if temp_directory is None:
+        return cell_index
+
+    for name in CELL_INDEX_ARRAYS:
+        np.save(os.path.join(temp_directory, name + '.npy'), getattr(cell_index, name))
+
+    _commit_entry(temp_directory, entry_directory, {'source': os.path.realpath(filename), 'num_cells': cell_index.num_cells})
+
+    return cell_index
+
+
+def get_sorted_entry(filename, max_memory=constants.SORT_MEMORY_LIMIT, cache=True):
+    # Cell-major copy of a matrix file that is not grouped by cell, made by an external sort.
+    # Without cache (or a writable cache) it goes to a temporary directory, which the caller removes
+    temp_directory = None
+    if cache:
+        entry_directory = get_entry_directory(filename)
+
+        if _open_entry(entry_directory) is not None:
+            return entry_directory
+
+        temp_directory = _create_entry(entry_directory)
+
+    if temp_directory is None:
+        cache = False
+        temp_directory = _make_sort_directory(filename)
+        entry_directory = temp_directory
+
+    try:
+        num_entries = sort_matrix(filename, temp_directory, max_memory)
+    except:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+
+    if cache:
+        _commit_entry(temp_directory, entry_directory, {'source': os.path.realpath(filename), 'num_entries': num_entries})
+
+    return entry_directory
+
+
+def _make_sort_directory(filename):
+    # Next to the file, or in the system's temporary directory if the data is read-only
+    source_filename = os.path.realpath(filename)
+    prefix = '.' + os.path.basename(source_filename) + '-sorted-'
+
+    try:
+        return tempfile.mkdtemp(prefix=prefix, dir=os.path.dirname(source_filename))
+    except OSError as error:
+        logger.warning(f'Cannot sort {filename} next to it ({error}), sorting in {tempfile.gettempdir()}')
+        return tempfile.mkdtemp(prefix=prefix)
+
+
+def iter_cached_blocks(filename, chunksize, cache=True, sort_memory=constants.SORT_MEMORY_LIMIT):
+    # Streams blocks of whole cells, from the cache if there is one, writing the cache otherwise.
+    # Files that are not grouped by cell are sorted first, holding about sort_memory bytes in memory
+    if cache and get_cache_entry(filename) is not None:
+        logger.info(f'Reading {filename} from cache')
+        yield from load_matrix(get_entry_directory(filename)).iter_blocks(chunksize)
+        return
+
+    try:
+        cell_index = get_cell_index(filename, cache=cache)
+    except NotGroupedError as error:
+        logger.info(f'{error}, sorting it by cell')
+        entry_directory = get_sorted_entry(filename, max_memory=sort_memory, cache=cache)
+
+        try:
+            yield from load_matrix(entry_directory).iter_blocks(chunksize)
+        finally:
+            if not is_cache_entry(entry_directory):
+                shutil.rmtree(entry_directory, ignore_errors=True)
+
+        return
+
+    if not cache:
+        yield from iter_cell_blocks(filename, cell_index, chunksize)
+        return
+
+    entry_directory = get_entry_directory(filename)
+    num_entries = int(cell_index.rows[-1])
+
+    temp_directory = _create_entry(entry_directory)
+    if temp_directory is None:
+        yield from iter_cell_blocks(filename, cell_index, chunksize)
+        return
+
+    gene_idx = np.lib.format.open_memmap(os.path.join(temp_directory, 'gene_idx.npy'), mode='w+', dtype=np.int32, shape=(num_entries,))
+    log_count = np.lib.format.open_memmap(os.path.join(temp_directory, 'log_count.npy'), mode='w+', dtype=np.float64, shape=(num_entries,))
+    cell_idx = []
+    indptr = [np.zeros(1, dtype=np.int64)]
+    offset = 0
+    completed = False
+
+    try:
+        for block in iter_cell_blocks(filename, cell_index, chunksize):
+            gene_idx[offset:offset + block.num_entries] = block.gene_idx
+            log_count[offset:offset + block.num_entries] = block.log_count
+            cell_idx.append(block.cell_idx)
+            indptr.append(block.indptr[1:] + offset)
+            offset += block.num_entries
+
+            yield block
+
+        completed = True
+    finally:
+        gene_idx.flush()
+        log_count.flush()
+        del gene_idx, log_count
+
+        if completed:
+            np.save(os.path.join(temp_directory, 'cell_idx.npy'), np.concatenate(cell_idx) if len(cell_idx) > 0 else np.zeros(0, dtype=np.int32))
+            np.save(os.path.join(temp_directory, 'indptr.npy'), np.concatenate(indptr))
+            _commit_entry(temp_directory, entry_directory, {'source': os.path.realpath(filename), 'num_entries': num_entries})
+        else:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+
+def prune_cache(data_directory, max_size=constants.CACHE_SIZE_LIMIT):
+    # Evicts least recently used cache entries under data_directory until they fit in max_size bytes
+    entries = []
+    for root, dirs, files in os.walk(data_directory):
+        if os.path.basename(root) != constants.CACHE_DIRECTORY:
+            continue
+
+        for name in dirs:
+            entry_directory = os.path.join(root, name)
+            metadata_filename = os.path.join(entry_directory, constants.CACHE_METADATA_FILENAME)
+
+            # Entries still being written
+            if not os.path.exists(metadata_filename):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry_directory, filename)) for filename in os.listdir(entry_directory))
+            entries.append((os.path.getmtime(metadata_filename), size, entry_directory))
+
+        dirs[:] = []
+
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    logger.info(f'Cache entries: {len(entries)} using {round(total_size / 1024 ** 3, 2)} GB')
+
+    for _, size, entry_directory in entries:
+        if total_size <= max_size:
+            break
+
+        logger.info(f'Evicting cache entry {entry_directory}')
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        total_size -= size
+
+    return total_size
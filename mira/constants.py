@@ -8,8 +8,34 @@ JUNO_MARKERS_FILENAME = 'markers.tsv'
 SAMPLES_FILENAME = 'sample_metadata.json'
 MARKER_GENES_FILENAME = 'marker_genes.json'
 
+## Binary cache of parsed files
+CACHE_DIRECTORY = '.mira_cache'
+CACHE_METADATA_FILENAME = 'cache.json'
+CACHE_HASH_BLOCK_SIZE = 1024 * 1024
+CACHE_SIZE_LIMIT = 200 * 1024 ** 3
+# Entries per block when a whole matrix is streamed into the cache
+CACHE_BLOCK_SIZE = int(1e7)
+SORT_MEMORY_LIMIT = 4 * 1024 ** 3
+
+## Content hashes of the last load, for incremental reloads
+MANIFEST_DIRECTORY = '.mira_manifest'
+
+## Checkpoints of chunked loads, for resuming them
+CHECKPOINT_DIRECTORY = '.mira_checkpoint'
+
+## Versioned reloads, number of versions of each index kept (the live one included)
+KEEP_VERSIONS = 2
+
+## Concurrent dashboard loads
+LOAD_MEMORY_LIMIT = 64 * 1024 ** 3
+# Rough bytes per matrix entry held in memory, parsed and as cell records
+MEMORY_PER_ENTRY = 500
+
 MARKER_GENES_URL = "https://raw.githubusercontent.com/shahcompbio/shahlab_apps/master/shahlab_apps/apps/cellassign/hgsc_v5_major.csv"
 
+## Label of the per-bin total count documents written by sparse gene bins
+BIN_TOTAL_LABEL = "_total"
+
 ## Elasticsearch Index names
 DASHBOARD_ENTRY_INDEX = "dashboard_entry"
 DASHBOARD_BINS_PREFIX = "dashboard_bins_"
@@ -96,6 +122,51 @@ CELLS_INDEX_MAPPING = {
 }
 
 
+## Compact gene layout: parallel gene_ids / values arrays in place of nested genes objects,
+## so a cell is one Lucene document instead of one per expressed gene.
+## Only gene_ids is searchable, values are kept in _source in the same order.
+GENE_LAYOUTS = ['nested', 'compact']
+BENCHMARK_INDEX_PREFIX = 'benchmark_cells_'
+
+## Cohort subsets as filtered aliases on the cohort cells index
+COHORT_DASHBOARD_ID = "cohort_all"
+# Cohort cell field listing the subsets a cell is in, subset fields are <subset dashboard_id>_<field>
+SUBSETS_FIELD = "subsets"
+SUBSET_CELL_FIELDS = ["x", "y", "cluster_label"]
+
+CELLS_COMPACT_INDEX_MAPPING = {
+    "settings": {
+        "index": {
+            "max_result_window": 50000,
+            "refresh_interval": -1
+        }
+    },
+    'mappings': {
+        "dynamic_templates": [
+            {
+                "string_values": {
+                    "match": "*",
+                    "match_mapping_type": "string",
+                    "mapping": {
+                        "type": "keyword"
+                    }
+                }
+            }
+        ],
+        "properties": {
+            "gene_ids": {
+                "type": "keyword"
+            },
+            "values": {
+                "type": "float",
+                "index": False,
+                "doc_values": False
+            }
+        }
+    }
+}
+
+
 DASHBOARD_ENTRY_INDEX_MAPPING = {
     "settings": {
         "index": {
@@ -0,0 +1,156 @@
+import logging
+import os
+import json
+import hashlib
+import pandas as pd
+
+from mira.elasticsearch import count_documents, delete_documents, delete_bins
+from utils.versions import get_version_index
+from utils.dead_letter import check_dead_letters
+import mira.constants as constants
+
+logger = logging.getLogger('mira_loading')
+
+
+## Incremental reloads
+## A manifest next to the data keeps the content hash of every cell document (by cell_id) and of every
+## (x, y) bin of the last load, so a reload only indexes what changed and deletes what is gone.
+## A manifest that doesn't match the index (missing, or a different number of documents) means a full load,
+## into a new version of the indices, which writes the manifests for the versions it publishes.
+
+
+def get_hash(record):
+    return hashlib.blake2b(json.dumps(record, sort_keys=True, default=_to_json).encode(), digest_size=8).hexdigest()
+
+
+def _to_json(value):
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def _get_manifest_filename(directory, index_name):
+    return os.path.join(directory, constants.MANIFEST_DIRECTORY, index_name + '.pkl')
+
+
+def read_manifest(directory, index_name, host, port):
+    manifest_filename = _get_manifest_filename(directory, index_name)
+
+    if not os.path.exists(manifest_filename):
+        logger.info(f'No manifest for {index_name}, loading in full')
+        return None
+
+    manifest = pd.read_pickle(manifest_filename)
+    num_documents = count_documents(index_name, host, port)
+
+    if num_documents != manifest['num_documents']:
+        logger.info(f'Manifest for {index_name} has {manifest["num_documents"]} documents but index has {num_documents}, loading in full')
+        return None
+
+    return manifest['hashes']
+
+
+def write_manifest(directory, index_name, hashes, host, port, version=None):
+    # Manifests are named after the dashboard's index, whichever version they describe.
+    # Documents that failed to index would be taken as unchanged by the next load
+    check_dead_letters([get_version_index(index_name, version)])
+
+    manifest_filename = _get_manifest_filename(directory, index_name)
+    os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+
+    manifest = {'hashes': hashes, 'num_documents': count_documents(get_version_index(index_name, version), host, port)}
+
+    pd.to_pickle(manifest, manifest_filename + '.tmp')
+    os.replace(manifest_filename + '.tmp', manifest_filename)
+
+
+def has_manifests(directory, dashboard_id, host, port, cells=True):
+    # Whether an incremental load can go on from what is indexed (aliased cohort subsets have no cells of their own)
+    index_names = [constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower()]
+    if cells:
+        index_names.append(constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower())
+
+    return all(read_manifest(directory, index_name, host, port) is not None for index_name in index_names)
+
+
+def delete_manifests(directory, dashboard_id):
+    # After a full reload, the manifests no longer describe what is indexed
+    for index_name in [constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower(), constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower()]:
+        manifest_filename = _get_manifest_filename(directory, index_name)
+
+        if os.path.exists(manifest_filename):
+            os.remove(manifest_filename)
+
+
+class CellDelta():
+    # Filters cell records down to the ones that changed, by cell_id.
+    # A versioned load indexes every cell into its new index, and only keeps the hashes for the next load
+
+    def __init__(self, directory, dashboard_id, host, port, version=None):
+        self.directory = directory
+        self.index_name = constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower()
+        self.version = version
+        self.previous = None if version is not None else read_manifest(directory, self.index_name, host, port)
+        self.hashes = {}
+        self.num_changed = 0
+
+        if version is None and self.previous is None:
+            raise ValueError(f'No manifest for {self.index_name}, incremental loads without one are versioned full loads')
+
+    def filter(self, records):
+        for record in records:
+            cell_id = record['cell_id']
+            record_hash = get_hash(record)
+
+            if cell_id in self.hashes:
+                raise ValueError(f'duplicate cell_id {cell_id}')
+            self.hashes[cell_id] = record_hash
+
+            if self.previous is not None and self.previous.get(cell_id) == record_hash:
+                continue
+
+            self.num_changed += 1
+            yield record
+
+    def finish(self, host, port):
+        # Deletes cells that are gone and saves the new manifest, once the index is refreshed
+        removed = [] if self.previous is None else [cell_id for cell_id in self.previous if cell_id not in self.hashes]
+        delete_documents(self.index_name, removed, host, port)
+
+        logger.info(f'Cells: {self.num_changed} indexed, {len(self.hashes) - self.num_changed} unchanged, {len(removed)} deleted')
+
+        write_manifest(self.directory, self.index_name, self.hashes, host, port, version=self.version)
+
+
+def get_bin_hashes(categorical_records, gene_bins, sparse):
+    # One hash per (x, y) bin over its categorical records and gene sums
+    categorical_hashes = {}
+    for record in categorical_records:
+        categorical_hashes.setdefault((float(record['x']), float(record['y'])), []).append(get_hash(record))
+
+    gene_hashes = gene_bins.get_bin_hashes()
+
+    return {
+        bin: get_hash([sorted(categorical_hashes.get(bin, [])), gene_hashes.get(bin), sparse])
+        for bin in set(categorical_hashes) | set(gene_hashes)
+    }
+
+
+def get_changed_bins(directory, dashboard_id, hashes, host, port, version=None):
+    # Returns the bins to index (None for all of them, into a new version), after deleting the documents of bins
+    # that changed or are gone
+    if version is not None:
+        return None
+
+    index_name = constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower()
+    previous = read_manifest(directory, index_name, host, port)
+
+    if previous is None:
+        raise ValueError(f'No manifest for {index_name}, incremental loads without one are versioned full loads')
+
+    changed = set(bin for bin, bin_hash in hashes.items() if previous.get(bin) != bin_hash)
+    removed = set(previous) - set(hashes)
+
+    logger.info(f'Bins: {len(changed)} changed, {len(hashes) - len(changed)} unchanged, {len(removed)} deleted')
+
+    delete_bins(dashboard_id, sorted((changed & set(previous)) | removed), host, port)
+
+    return changed
@@ -1,5 +1,10 @@
-from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from elasticsearch.exceptions import RequestError
+from utils.es_client import get_client
+from utils.pipeline import pipelined_bulk
+from utils.dead_letter import get_dead_letter_file, replay_dead_letters, check_dead_letters
+from utils.index_profile import get_loading_mapping, apply_serving_settings
+from utils.versions import get_version_index, get_versions, get_alias_indices, swap_alias, remove_old_versions, delete_versions
 
 import mira.constants as constants
 
@@ -8,88 +13,31 @@ logger = logging.getLogger('mira_loading')
 
 
 def initialize_es(host, port):
-    es = Elasticsearch(hosts=[{'host': host, 'port': port}], retry_on_timeout=True, timeout=300)
-    return es
+    return get_client(host, port, retry_on_timeout=True, timeout=300)
 
 
-def get_bin_sizes(dashboard_id, host, port):
+def get_cell_type_counts(dashboard_id, host, port):
+    # Number of cells of every cell type, in one terms aggregation
     es = initialize_es(host, port)
 
     index = constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower()
 
-    query = {
-        "size": 0,
-        "aggs": {
-            "agg_stats_x": {
-                "stats": { 
-                    "field": "x"
-                }
-            },
-            "agg_stats_y": {
-                "stats": {
-                    "field": "y"
-                }
-            }
-        }
-    }
-
-    result = es.search(index=index, body=query)
-
-    x_stats = result["aggregations"]["agg_stats_x"]
-    y_stats = result["aggregations"]["agg_stats_y"]
-
-    ## We assume 100 x 100 bins
-    return [ (x_stats["max"] - x_stats["min"]) / 100, (y_stats["max"] - y_stats["min"]) / 100]
-
-
-def get_genes(host, port):
-    es = initialize_es(host, port)
-
-    query = {
-        "size": 50000,
-        "sort": [
-            {
-            "gene": {
-                "order": "asc"
-            }
-            }
-        ]
-    }
-
-    result = es.search(index="genes", body=query)
-
-    return [record["_source"]["gene"] for record in result["hits"]["hits"]]
-
-
-def msearch(host, port, dashboard_id, query):
-    es = initialize_es(host, port)
-    index = constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower()
-
-    results = es.msearch(index=index, body=query)
-
-    print(len(results["response"]))
-
-def get_cell_type_count(cell_type, dashboard_id, host, port):
-    es = initialize_es(host, port)
-
-    index = constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower()
-    
     if not es.indices.exists(index):
-        return 0
+        return {}
 
-    result = es.count(index=index, body={
-        "query": {
-            "bool": {
-                "filter": {
-                    "term": {
-                        "cell_type": cell_type
-                    }
+    result = es.search(index=index, body={
+        "size": 0,
+        "aggs": {
+            "cell_types": {
+                "terms": {
+                    "field": "cell_type",
+                    "size": 10000
                 }
             }
         }
     })
 
-    return result["count"]
+    return {bucket["key"]: bucket["doc_count"] for bucket in result["aggregations"]["cell_types"]["buckets"]}
 
     
 
@@ -151,12 +99,25 @@ def query_cell_type_count(dashboard_id, cell_type, host, port):
 
 
 ## probably want to turn off index refresh here too
-def load_cells(records, dashboard_id, host, port, refresh=False):
-    load_records(records, constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower(),constants.CELLS_INDEX_MAPPING, host, port)
+def load_cells(records, dashboard_id, host, port, refresh=False, gene_layout='nested', version=None):
+    load_records(_add_ids(records, get_cell_doc_id), get_cells_index(dashboard_id, version), get_cells_mapping(gene_layout), host, port, loading_settings=True)
 
     if refresh:
-        es = initialize_es(host, port)
-        es.indices.refresh(constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower())
+        refresh_cells(dashboard_id, host, port, version=version)
+
+def create_cells_index(dashboard_id, host, port, gene_layout='nested', version=None):
+    # For loads that fork workers, so they don't all try to create it
+    create_index(get_cells_index(dashboard_id, version), get_cells_mapping(gene_layout), host, port, loading_settings=True)
+
+def get_cells_mapping(gene_layout='nested'):
+    return constants.CELLS_COMPACT_INDEX_MAPPING if gene_layout == 'compact' else constants.CELLS_INDEX_MAPPING
+
+def refresh_cells(dashboard_id, host, port, version=None):
+    es = initialize_es(host, port)
+    es.indices.refresh(get_cells_index(dashboard_id, version))
+
+def get_cells_index(dashboard_id, version=None):
+    return get_version_index(constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower(), version)
 
 def load_dashboard_entry(record, dashboard_id, host, port):
     load_record(record, dashboard_id, constants.DASHBOARD_ENTRY_INDEX, constants.DASHBOARD_ENTRY_INDEX_MAPPING, host, port)
@@ -167,29 +128,68 @@ def load_rho(records, host, port):
 def load_genes(records, host, port):
     load_records(records, constants.GENES_INDEX, constants.GENES_MAPPING, host, port)
 
-def load_bins(records, dashboard_id, host, port, refresh=False):
-    load_records(records, constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower(), constants.BINS_INDEX_MAPPING, host, port)
+def load_bins(records, dashboard_id, host, port, refresh=False, version=None):
+    load_records(_add_ids(records, get_bin_doc_id), get_bins_index(dashboard_id, version), constants.BINS_INDEX_MAPPING, host, port, loading_settings=True)
 
     if refresh:
-        es = initialize_es(host, port)
-        es.indices.refresh(constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower())
+        refresh_bins(dashboard_id, host, port, version=version)
+
+def refresh_bins(dashboard_id, host, port, version=None):
+    es = initialize_es(host, port)
+    es.indices.refresh(get_bins_index(dashboard_id, version))
+
+def get_bins_index(dashboard_id, version=None):
+    return get_version_index(constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower(), version)
+
 
+## Document ids from natural keys, so a batch sent again (retried or resumed) replaces its documents
+## instead of adding copies of them
 
-def load_records(records, index_name, mapping, host, port):
+def get_cell_doc_id(record):
+    return record['cell_id']
+
+def get_bin_doc_id(record):
+    # Categorical bins have int coordinates and gene bins float ones, for the same bins
+    return f"{int(record['x'])}:{int(record['y'])}:{record['label']}"
+
+def _add_ids(records, get_id):
+    for record in records:
+        record['_id'] = get_id(record)
+        yield record
+
+
+def create_index(index_name, mapping, host, port, loading_settings=False):
     es = initialize_es(host, port)
 
-    if not es.indices.exists(index_name):
-        logger.info(f'No index found - creating index named {index_name}')
+    if es.indices.exists(index_name):
+        return
+
+    logger.info(f'No index found - creating index named {index_name}' + (' with the loading settings' if loading_settings else ''))
+    try:
         es.indices.create(
             index=index_name,
-            body=mapping
+            body=get_loading_mapping(mapping) if loading_settings else mapping
         )
-    
-    for success, info in helpers.parallel_bulk(es, records, index=index_name):
-        if not success:
-            # logger.error(info)
-            logger.info(info)
-            logger.info('Doc failed in parallel loading')
+    except RequestError as error:
+        # Created by another process loading into it at the same time
+        if error.error != 'resource_already_exists_exception':
+            raise
+
+
+def load_records(records, index_name, mapping, host, port, loading_settings=False):
+    es = initialize_es(host, port)
+
+    create_index(index_name, mapping, host, port, loading_settings=loading_settings)
+
+    # Records are built, encoded and sent in overlapping stages, returns how many were indexed
+    return pipelined_bulk(es, records, index_name, dead_letter_file=get_dead_letter_file(), logger=logger)
+
+
+def replay_failed(filename, host, port):
+    # Sends the documents of a dead letter file again
+    es = initialize_es(host, port)
+
+    return replay_dead_letters(es, filename, lambda es, records, index_name: pipelined_bulk(es, records, index_name, dead_letter_file=get_dead_letter_file(), logger=logger), logger=logger)
 
 def load_record(record, record_id, index, mapping, host="localhost", port=9200):
     es = initialize_es(host, port)
@@ -213,6 +213,8 @@ def clean_analysis(dashboard_id, host, port):
     logger.info("Cleaning records")
 
     logger.info("DELETE DATA")
+    # Cohort subsets can be aliases on the cohort cells, removing them leaves the cohort's cells alone
+    delete_alias(constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower(), host=host, port=port)
     delete_index(constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower(), host=host, port=port)
 
     delete_index(constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower(), host=host, port=port)
@@ -246,12 +248,121 @@ def clean_rho(dashboard_id, host, port):
     delete_records(constants.MARKER_GENES_INDEX, dashboard_id, host=host, port=port)
 
 
+def create_cells_alias(dashboard_id, base_dashboard_id, host, port, version=None):
+    # Cells of dashboard_id as a filtered alias on the cells index of base_dashboard_id (of version, for versioned loads)
+    es = initialize_es(host, port)
+
+    alias = get_cells_index(dashboard_id)
+    index = get_cells_index(base_dashboard_id, version)
+
+    # Aliases point to indices, so an unversioned load on a versioned base points to its live version
+    if es.indices.exists_alias(name=index):
+        [index] = get_alias_indices(es, index)
+
+    logger.info(f'Creating alias {alias} on {index}')
+    swap_alias(es, alias, index, filter={
+        "term": {
+            constants.SUBSETS_FIELD: dashboard_id
+        }
+    }, logger=logger)
+
+    # Cells indices the subset had of its own
+    for version_index in get_versions(es, alias):
+        es.indices.delete(index=version_index, ignore=[400, 404])
+
+
+def finish_indices(dashboard_id, host, port, version=None, max_num_segments=None, cells=True):
+    # Serving settings for the cells and bins indices, once they are loaded
+    es = initialize_es(host, port)
+
+    indices = [get_cells_index(dashboard_id, version), get_bins_index(dashboard_id, version)] if cells else [get_bins_index(dashboard_id, version)]
+
+    for index in indices:
+        if es.indices.exists(index):
+            apply_serving_settings(es, index, max_num_segments=max_num_segments, logger=logger)
+
+
+def publish_version(dashboard_id, version, host, port, keep_versions=constants.KEEP_VERSIONS):
+    # Points the dashboard's indices to the ones loaded as version, once they are checked
+    es = initialize_es(host, port)
+
+    # Aliased cohort subsets have no cells of their own
+    indices = {alias: get_version_index(alias, version) for alias in [get_cells_index(dashboard_id), get_bins_index(dashboard_id)]}
+    indices = {alias: index for alias, index in indices.items() if es.indices.exists(index)}
+
+    check_dead_letters(list(indices.values()))
+
+    for alias, index in indices.items():
+        es.indices.refresh(index)
+
+        logger.info(f'Pointing {alias} to {index}')
+        swap_alias(es, alias, index, logger=logger)
+        remove_old_versions(es, alias, keep_versions, logger=logger)
+
+
+def discard_version(dashboard_id, version, host, port):
+    # Indices of a failed versioned load, the live ones are untouched
+    for index in [get_cells_index(dashboard_id, version), get_bins_index(dashboard_id, version)]:
+        delete_index(index, host=host, port=port)
+
+
+def delete_alias(alias, host="localhost", port=9200):
+    es = initialize_es(host, port)
+    if es.indices.exists_alias(name=alias):
+        es.indices.delete_alias(index='_all', name=alias)
+
+
 def delete_index(index, host="localhost", port=9200):
     es = initialize_es(host, port)
+
+    # After versioned loads, index is an alias to its versions
+    delete_versions(es, index, logger=logger)
+
     if es.indices.exists(index):
         es.indices.delete(index=index, ignore=[400, 404])
 
 
+def count_documents(index, host="localhost", port=9200):
+    # Top level documents in index, None if there is no index
+    es = initialize_es(host, port)
+    if not es.indices.exists(index):
+        return None
+
+    return es.count(index=index)["count"]
+
+
+def delete_documents(index, ids, host="localhost", port=9200):
+    if len(ids) == 0:
+        return
+
+    es = initialize_es(host, port)
+    logger.info(f'Deleting {len(ids)} documents from {index}')
+
+    actions = ({"_op_type": "delete", "_index": index, "_id": doc_id} for doc_id in ids)
+    helpers.bulk(es, actions, raise_on_error=False)
+    es.indices.refresh(index)
+
+
+def delete_bins(dashboard_id, bins, host, port, batch_size=1000):
+    # All documents of the given (x, y) bins
+    if len(bins) == 0:
+        return
+
+    es = initialize_es(host, port)
+    index = constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower()
+    logger.info(f'Deleting documents of {len(bins)} bins from {index}')
+
+    for start in range(0, len(bins), batch_size):
+        es.delete_by_query(index=index, refresh=True, body={
+            "query": {
+                "bool": {
+                    "should": [{"bool": {"filter": [{"term": {"x": x}}, {"term": {"y": y}}]}} for x, y in bins[start:start + batch_size]],
+                    "minimum_should_match": 1
+                }
+            }
+        })
+
+
 def delete_records(index, filter_value, host="localhost", port=9200):
     es = initialize_es(host, port)
 
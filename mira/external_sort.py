@@ -0,0 +1,95 @@
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from mira.matrix import iter_triplets, _split_by_entries
+
+logger = logging.getLogger('mira_loading')
+
+
+## External merge sort of matrix.mtx into cell-major binary arrays, for files that are not grouped by cell
+## Writes cell_idx, indptr, gene_idx and log_count .npy files (the CellMatrix layout of the cache)
+## while holding at most about max_memory bytes of entries in memory
+
+# Parsed entry (int32 gene, int32 cell, float64 count) plus parsing and argsort overhead
+BYTES_PER_ENTRY = 64
+
+
+def sort_matrix(filename, output_directory, max_memory):
+    max_entries = max(int(max_memory // BYTES_PER_ENTRY), 1)
+    run_directory = tempfile.mkdtemp(prefix='runs-', dir=output_directory)
+
+    try:
+        [runs, cell_counts] = _write_runs(filename, run_directory, max_entries)
+        num_entries = _merge_runs(runs, cell_counts, output_directory, max_entries)
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+    return num_entries
+
+
+def _write_runs(filename, run_directory, max_entries):
+    # Sorted runs of at most max_entries, stable so entries of a cell keep their file order
+    runs = []
+    cell_counts = np.zeros(1, dtype=np.int64)
+
+    for [gene_idx, cell_idx, log_count] in iter_triplets(filename, chunksize=max_entries):
+        order = np.argsort(cell_idx, kind='stable')
+
+        run_filename = os.path.join(run_directory, f'run_{len(runs)}')
+        cell_idx[order].tofile(run_filename + '.cell_idx')
+        gene_idx[order].tofile(run_filename + '.gene_idx')
+        log_count[order].tofile(run_filename + '.log_count')
+        runs.append((run_filename, cell_idx.shape[0]))
+
+        counts = np.bincount(cell_idx)
+        if counts.shape[0] > cell_counts.shape[0]:
+            cell_counts = np.concatenate((cell_counts, np.zeros(counts.shape[0] - cell_counts.shape[0], dtype=np.int64)))
+        cell_counts[:counts.shape[0]] += counts
+
+        logger.info(f'Sorted run {len(runs)} with {cell_idx.shape[0]} entries')
+
+    return runs, cell_counts
+
+
+def _merge_runs(runs, cell_counts, output_directory, max_entries):
+    # Merges runs one window of cells at a time, each window holding at most max_entries (unless a single cell is larger)
+    cells = np.flatnonzero(cell_counts)
+    indptr = np.concatenate(([0], np.cumsum(cell_counts[cells]))).astype(np.int64)
+    num_entries = int(indptr[-1])
+
+    np.save(os.path.join(output_directory, 'cell_idx.npy'), cells.astype(np.int32))
+    np.save(os.path.join(output_directory, 'indptr.npy'), indptr)
+
+    gene_idx = np.lib.format.open_memmap(os.path.join(output_directory, 'gene_idx.npy'), mode='w+', dtype=np.int32, shape=(num_entries,))
+    log_count = np.lib.format.open_memmap(os.path.join(output_directory, 'log_count.npy'), mode='w+', dtype=np.float64, shape=(num_entries,))
+
+    run_arrays = [(np.memmap(run_filename + '.cell_idx', dtype=np.int32, mode='r', shape=(length,)),
+                   np.memmap(run_filename + '.gene_idx', dtype=np.int32, mode='r', shape=(length,)),
+                   np.memmap(run_filename + '.log_count', dtype=np.float64, mode='r', shape=(length,)))
+                  for [run_filename, length] in runs if length > 0]
+
+    for [start, end] in _split_by_entries(indptr, max_entries):
+        [first_cell, last_cell] = [cells[start], cells[end - 1]]
+
+        window = []
+        for [run_cell_idx, run_gene_idx, run_log_count] in run_arrays:
+            run_start = np.searchsorted(run_cell_idx, first_cell, side='left')
+            run_end = np.searchsorted(run_cell_idx, last_cell, side='right')
+            window.append((run_cell_idx[run_start:run_end], run_gene_idx[run_start:run_end], run_log_count[run_start:run_end]))
+
+        # Runs are in file order, so a stable sort keeps entries of a cell in file order
+        window_cell_idx = np.concatenate([values[0] for values in window])
+        order = np.argsort(window_cell_idx, kind='stable')
+
+        gene_idx[indptr[start]:indptr[end]] = np.concatenate([values[1] for values in window])[order]
+        log_count[indptr[start]:indptr[end]] = np.concatenate([values[2] for values in window])[order]
+
+    gene_idx.flush()
+    log_count.flush()
+
+    logger.info(f'Merged {len(runs)} runs into {cells.shape[0]} cells and {num_entries} entries')
+
+    return num_entries
@@ -0,0 +1,289 @@
+import logging
+import io
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('mira_loading')
+
+
+## Matrix Market reader for matrix.mtx
+## Rows are genes, columns are cells, both 1-based.
+## Entries are kept as a compressed sparse column structure (one column per cell)
+## so names can be resolved by integer indexing instead of DataFrame joins
+
+
+class CellMatrix():
+
+    def __init__(self, cell_idx, indptr, gene_idx, log_count):
+        # cell_idx[i] is the 1-based cell index of column i,
+        # its entries are gene_idx/log_count[indptr[i]:indptr[i + 1]]
+        self.cell_idx = cell_idx
+        self.indptr = indptr
+        self.gene_idx = gene_idx
+        self.log_count = log_count
+
+    @classmethod
+    def from_triplets(cls, gene_idx, cell_idx, log_count):
+        # Stable so genes keep their file order within a cell
+        order = np.argsort(cell_idx, kind='stable')
+
+        cell_idx = cell_idx[order]
+        columns, counts = np.unique(cell_idx, return_counts=True)
+
+        indptr = np.zeros(columns.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(columns, indptr, gene_idx[order], log_count[order])
+
+    @classmethod
+    def from_grouped_triplets(cls, gene_idx, cell_idx, log_count):
+        # Entries of each cell are on consecutive lines, so cells keep their file order
+        starts = np.flatnonzero(np.diff(cell_idx)) + 1
+        if cell_idx.shape[0] > 0:
+            starts = np.concatenate(([0], starts))
+
+        indptr = np.concatenate((starts, [cell_idx.shape[0]])).astype(np.int64)
+
+        return cls(cell_idx[starts], indptr, gene_idx, log_count)
+
+    @property
+    def num_cells(self):
+        return self.cell_idx.shape[0]
+
+    @property
+    def num_entries(self):
+        return self.gene_idx.shape[0]
+
+    def slice(self, start, end):
+        # Columns [start, end) as views on the underlying arrays
+        [entry_start, entry_end] = [self.indptr[start], self.indptr[end]]
+
+        return CellMatrix(self.cell_idx[start:end], self.indptr[start:end + 1] - entry_start,
+                          self.gene_idx[entry_start:entry_end], self.log_count[entry_start:entry_end])
+
+    def iter_blocks(self, chunksize):
+        # Blocks of whole cells with at most chunksize entries (unless a single cell is larger)
+        for [start, end] in _split_by_entries(self.indptr, chunksize):
+            yield self.slice(start, end)
+
+    def get_partitions(self, num_partitions):
+        # Column ranges with about equal numbers of entries
+        return _partition_by_entries(self.indptr, num_partitions)
+
+    def to_frame(self):
+        return pd.DataFrame({
+            'gene_idx': self.gene_idx,
+            'cell_idx': np.repeat(self.cell_idx, np.diff(self.indptr)),
+            'log_count': self.log_count
+        })
+
+    def filter(self, entry_mask=None, column_mask=None):
+        # Drop entries and/or whole columns, keeping the CSC layout
+        if column_mask is None:
+            column_mask = np.ones(self.num_cells, dtype=bool)
+
+        if entry_mask is None:
+            entry_mask = np.ones(self.num_entries, dtype=bool)
+
+        entry_mask = entry_mask & np.repeat(column_mask, np.diff(self.indptr))
+
+        kept = np.zeros(self.num_entries + 1, dtype=np.int64)
+        np.cumsum(entry_mask, out=kept[1:])
+        indptr = kept[self.indptr]
+
+        column_indptr = np.concatenate((indptr[:-1][column_mask], [indptr[-1]]))
+
+        return CellMatrix(self.cell_idx[column_mask], column_indptr, self.gene_idx[entry_mask], self.log_count[entry_mask])
+
+
+def read_header(filename):
+    # Returns number of genes, cells, entries and the number of lines before the first entry
+    num_lines = 0
+    with open(filename) as matrix_file:
+        for line in matrix_file:
+            num_lines += 1
+            if not line.startswith('%'):
+                break
+
+    [num_genes, num_cells, num_entries] = [int(value) for value in line.split()[:3]]
+
+    return num_genes, num_cells, num_entries, num_lines
+
+
+def iter_triplets(filename, chunksize=None, start=None, end=None):
+    # Entries of the whole file, or of the byte range [start, end) which must fall on line boundaries
+    num_genes, num_cells, num_entries, num_header_lines = read_header(filename)
+
+    if start is None:
+        matrix_file = filename
+        skiprows = num_header_lines
+    else:
+        matrix_file = io.BufferedReader(_ByteRange(filename, start, end))
+        skiprows = 0
+
+    matrix_iter = pd.read_csv(matrix_file, sep=' ', header=None, usecols=[0, 1, 2], skiprows=skiprows,
+                              names=['gene_idx', 'cell_idx', 'log_count'],
+                              dtype={'gene_idx': np.int32, 'cell_idx': np.int32, 'log_count': np.float64},
+                              chunksize=chunksize)
+
+    if chunksize is None:
+        matrix_iter = [matrix_iter]
+
+    for matrix_chunk in matrix_iter:
+        yield matrix_chunk['gene_idx'].values, matrix_chunk['cell_idx'].values, matrix_chunk['log_count'].values
+
+
+class _ByteRange(io.RawIOBase):
+
+    def __init__(self, filename, start, end):
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+
+        num_read = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= num_read
+        return num_read
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def read_matrix(filename):
+    [gene_idx, cell_idx, log_count] = next(iter_triplets(filename))
+
+    return CellMatrix.from_triplets(gene_idx, cell_idx, log_count)
+
+
+def iter_cell_blocks(filename, cell_index, chunksize, start=0, end=None):
+    # Streams matrix (or cells [start, end) of its index) in blocks of whole cells, in file order whatever the block size
+    for [start, end] in _split_by_entries(cell_index.rows, chunksize, start=start, end=end):
+        [gene_idx, cell_idx, log_count] = next(iter_triplets(filename, start=cell_index.offsets[start], end=cell_index.offsets[end]))
+
+        yield CellMatrix.from_grouped_triplets(gene_idx, cell_idx, log_count)
+
+
+class NotGroupedError(ValueError):
+    # Entries of a cell are not on consecutive lines, so the file can't be read by cell ranges
+    pass
+
+
+class CellIndex():
+    # Where the entries of each cell are in matrix.mtx, in file order
+
+    def __init__(self, cell_idx, rows, offsets):
+        # Entries of cell cell_idx[i] are rows [rows[i], rows[i + 1]),
+        # found at bytes [offsets[i], offsets[i + 1]) of the file
+        self.cell_idx = cell_idx
+        self.rows = rows
+        self.offsets = offsets
+
+    @property
+    def num_cells(self):
+        return self.cell_idx.shape[0]
+
+    def get_partitions(self, num_partitions):
+        # Cell ranges with about equal numbers of entries
+        return _partition_by_entries(self.rows, num_partitions)
+
+
+def build_cell_index(filename, chunksize=int(1e7)):
+    # One pass over the cell column to find where each cell starts, then over the bytes to find those lines
+    num_genes, num_cells, num_entries, num_header_lines = read_header(filename)
+
+    logger.info(f'Indexing cells of {filename}')
+
+    cell_starts = []
+    cells = []
+    num_rows = 0
+    prev_cell_idx = None
+
+    for cell_chunk in pd.read_csv(filename, sep=' ', header=None, usecols=[1], skiprows=num_header_lines, dtype=np.int32, chunksize=chunksize):
+        cell_idx = cell_chunk[1].values
+
+        changes = np.flatnonzero(np.diff(cell_idx)) + 1
+        if prev_cell_idx is None or cell_idx[0] != prev_cell_idx:
+            changes = np.concatenate(([0], changes))
+
+        cell_starts.append(changes + num_rows)
+        cells.append(cell_idx[changes])
+
+        num_rows += cell_idx.shape[0]
+        prev_cell_idx = cell_idx[-1]
+
+    cell_starts = np.concatenate(cell_starts) if len(cell_starts) > 0 else np.zeros(0, dtype=np.int64)
+    cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, dtype=np.int32)
+
+    [unique_cells, counts] = np.unique(cells, return_counts=True)
+    if (counts > 1).any():
+        raise NotGroupedError(f'{filename} is not grouped by cell, entries of {(counts > 1).sum()} cells (e.g. {unique_cells[counts > 1][:5].tolist()}) are split over several runs of lines')
+
+    rows = np.concatenate((cell_starts, [num_rows])).astype(np.int64)
+    offsets = _get_line_offsets(filename, num_header_lines, rows)
+
+    logger.info(f'Indexed {cells.shape[0]} cells and {num_rows} entries')
+
+    return CellIndex(cells, rows, offsets)
+
+
+def _get_line_offsets(filename, num_header_lines, rows, block_size=64 * 1024 * 1024):
+    # Byte offsets of the given (sorted) data rows, a row past the last one maps to the end of the data
+    with open(filename, 'rb') as matrix_file:
+        for _ in range(num_header_lines):
+            matrix_file.readline()
+
+        position = matrix_file.tell()
+
+        # Row r > 0 starts right after newline number r - 1
+        offsets = np.full(rows.shape[0], position, dtype=np.int64)
+        targets = rows - 1
+        target = np.searchsorted(targets, 0)
+        num_newlines = 0
+
+        while target < targets.shape[0]:
+            block = matrix_file.read(block_size)
+            if not block:
+                break
+
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            block_end = np.searchsorted(targets, num_newlines + newlines.shape[0])
+
+            offsets[target:block_end] = position + newlines[targets[target:block_end] - num_newlines] + 1
+
+            target = block_end
+            num_newlines += newlines.shape[0]
+            position += len(block)
+
+        # No newline at the end of the file
+        offsets[target:] = position
+
+    return offsets
+
+
+def _split_by_entries(indptr, chunksize, start=0, end=None):
+    # Ranges of whole columns with at most chunksize entries (unless a single column is larger)
+    end = indptr.shape[0] - 1 if end is None else end
+
+    while start < end:
+        split = np.searchsorted(indptr, indptr[start] + chunksize, side='right') - 1
+        split = int(min(max(split, start + 1), end))
+
+        yield start, split
+        start = split
+
+
+def _partition_by_entries(indptr, num_partitions):
+    # Column ranges with about equal numbers of entries
+    num_columns = indptr.shape[0] - 1
+    targets = indptr[-1] * np.arange(1, num_partitions) // num_partitions
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(indptr, targets), [num_columns])))
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
@@ -2,9 +2,20 @@
 import logging
 import os
 import pandas as pd
+import numpy as np
 import json
-
-from mira.elasticsearch import load_cells, load_bins as _load_bins, load_dashboard_entry as _load_dashboard_entry, load_rho as _load_rho, get_cell_type_count, get_genes, get_bin_sizes, initialize_es
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from mira.elasticsearch import load_cells, create_cells_index, refresh_cells, load_bins as _load_bins, load_dashboard_entry as _load_dashboard_entry, load_rho as _load_rho, get_cell_type_counts, create_cells_alias, clean_rho, refresh_bins, publish_version, discard_version, finish_indices, get_bins_index, get_cells_index, delete_index
+from mira.matrix import NotGroupedError, read_header, iter_cell_blocks
+from mira.cache import read_table, read_cached_matrix, iter_cached_blocks, get_cache_entry, load_matrix, get_cell_index, get_sorted_entry, get_fingerprint, is_cache_entry
+from mira.bins import GeneBins, get_bin_sizes, get_categorical_bins
+from mira.delta import CellDelta, get_bin_hashes, get_changed_bins, write_manifest, delete_manifests, has_manifests
+from utils.versions import get_new_version
+from utils.checkpoint import read_checkpoint, write_checkpoint, delete_checkpoint
+from utils.dead_letter import check_dead_letters
 import mira.constants as constants
 
 
@@ -19,19 +30,136 @@ logger = logging.getLogger('mira_loading')
 ##   - matrix.mtx
 ##   - sample_metadata.json
 ##   - marker_genes.json
-def load_analysis(directory, type, dashboard_id, host, port, chunksize=None, metadata={}):
+def load_analysis(directory, type, dashboard_id, host, port, chunksize=None, metadata={}, cache=True, sparse_bins=False, workers=1, sort_memory=constants.SORT_MEMORY_LIMIT, gene_layout='nested', incremental=False, version=None, keep_versions=constants.KEEP_VERSIONS, merge_segments=None, resume=False):
     logger.info("====================== " + dashboard_id)
 
-    load_data(directory, dashboard_id, host, port, chunksize=chunksize, metadata=metadata)
-    load_bins(directory, type, dashboard_id, host, port)
-    load_rho(directory, dashboard_id, host, port)
+    # An incremental load needs manifests of what is indexed. Without them it is a full load into new indices,
+    # that replace the live ones once checked and leave manifests for the next incremental load
+    if incremental and version is None and not has_manifests(directory, dashboard_id, host, port):
+        version = get_new_version()
+        logger.info(f'Loading {dashboard_id} in full, as version {version}')
+
+    # A resumed load goes on in the indices the interrupted one was writing to
+    checkpoint = None
+    resumed = False
+    if not incremental:
+        checkpoint = get_resume_checkpoint(directory, dashboard_id, gene_layout) if resume else None
+        resumed = checkpoint is not None
+
+        if resumed:
+            version = checkpoint["version"]
+        else:
+            clear_checkpoint(directory, dashboard_id, version, host, port)
+            checkpoint = {"inputs": _get_load_inputs(directory, gene_layout), "version": version, "num_cells": 0}
+
+    # Marker gene counts come from cells.tsv, so they don't have to wait for the cells to be indexed
+    cells = read_cells(directory, cache=cache)
+
+    # Marker gene records have no ids to update, so they are replaced
+    if incremental or resumed or version is not None:
+        clean_rho(dashboard_id, host, port)
+
+    loaded = False
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            rho = executor.submit(load_rho, directory, dashboard_id, host, port, cells=cells)
+
+            # Partition workers fork, and must not inherit the marker genes load mid-request (its locks and sockets)
+            if workers > 1:
+                rho.result()
+
+            gene_bins = load_data(directory, dashboard_id, host, port, chunksize=chunksize, metadata=metadata, cache=cache, workers=workers, sort_memory=sort_memory, gene_layout=gene_layout, incremental=incremental, version=version, checkpoint=checkpoint)
+
+            # Bins are loaded in one go, an interrupted load may have left some in the version it was loading.
+            # Unversioned bins are the live ones, and are replaced by id
+            if resumed and version is not None:
+                delete_index(get_bins_index(dashboard_id, version), host=host, port=port)
+
+            load_bins(directory, type, dashboard_id, host, port, cache=cache, gene_bins=gene_bins, sparse=sparse_bins, incremental=incremental, version=version)
+
+            rho.result()
+
+        finish_indices(dashboard_id, host, port, version=version, max_num_segments=merge_segments)
+        loaded = True
+
+        if version is not None:
+            publish_version(dashboard_id, version, host, port, keep_versions=keep_versions)
+    except Exception:
+        # A version that failed to publish has nothing left to resume
+        if version is not None and (loaded or read_checkpoint(_get_checkpoint_filename(directory, dashboard_id)) is None):
+            discard_version(dashboard_id, version, host, port)
+            delete_checkpoint(_get_checkpoint_filename(directory, dashboard_id))
+        elif version is not None:
+            logger.info(f'Keeping version {version} of {dashboard_id} to resume from its checkpoint')
+
+        # Manifests may have been written for the discarded version
+        if incremental and version is not None:
+            delete_manifests(directory, dashboard_id)
+        raise
+
+    # Only incremental loads write manifests for the version they publish
+    if version is not None and not incremental:
+        delete_manifests(directory, dashboard_id)
+
+    # Readers need to know where to find genes in cell documents, and whether missing gene bins are zeros
+    if gene_layout != 'nested':
+        metadata = {**metadata, "gene_layout": gene_layout}
+    if sparse_bins:
+        metadata = {**metadata, "sparse_bins": True}
+
     load_dashboard_entry(directory, type,dashboard_id, metadata, host, port)
 
+    delete_checkpoint(_get_checkpoint_filename(directory, dashboard_id))
+
     logger.info("Done.")
     
 
 
-def load_rho(directory, dashboard_id, host, port):
+## Checkpoints of chunked loads
+## After every block the serial chunked load has indexed, the number of cells of the matrix stream it is done with is
+## written with the fingerprints of the input files. A resumed load reads those cells again for the gene bins but
+## doesn't index them, and the cells indexed again after the checkpoint replace their documents (ids are cell_ids).
+
+def _get_checkpoint_filename(directory, dashboard_id):
+    return os.path.join(directory, constants.CHECKPOINT_DIRECTORY, dashboard_id.lower() + '.json')
+
+
+def _get_load_inputs(directory, gene_layout):
+    filenames = [constants.CELLS_FILENAME, constants.GENES_FILENAME, constants.MATRIX_FILENAME, constants.SAMPLES_FILENAME]
+
+    return {
+        "files": {filename: get_fingerprint(os.path.join(directory, filename)) for filename in filenames},
+        "gene_layout": gene_layout
+    }
+
+
+def get_resume_checkpoint(directory, dashboard_id, gene_layout):
+    checkpoint = read_checkpoint(_get_checkpoint_filename(directory, dashboard_id))
+
+    if checkpoint is None:
+        logger.info(f'No checkpoint for {dashboard_id}, loading from the start')
+        return None
+
+    if checkpoint["inputs"] != _get_load_inputs(directory, gene_layout):
+        logger.info(f'Checkpoint of {dashboard_id} is for other input files or gene layout, loading from the start')
+        return None
+
+    logger.info(f'Resuming {dashboard_id} after {checkpoint["num_cells"]} cells' + ('' if checkpoint["version"] is None else f', in version {checkpoint["version"]}'))
+    return checkpoint
+
+
+def clear_checkpoint(directory, dashboard_id, version, host, port):
+    # Indices of an interrupted versioned load are not going to be resumed
+    checkpoint = read_checkpoint(_get_checkpoint_filename(directory, dashboard_id))
+
+    if checkpoint is not None and checkpoint["version"] is not None and checkpoint["version"] != version:
+        logger.info(f'Discarding version {checkpoint["version"]} of {dashboard_id} left by an interrupted load')
+        discard_version(dashboard_id, checkpoint["version"], host, port)
+
+    delete_checkpoint(_get_checkpoint_filename(directory, dashboard_id))
+
+
+def load_rho(directory, dashboard_id, host, port, cache=True, check=False, cells=None):
     logger.info("LOADING MARKER GENES: " + dashboard_id)
 
     logger.debug("Opening files")
@@ -40,12 +168,20 @@ def load_rho(directory, dashboard_id, host, port):
     with open(markers_filename) as markers_file:
         cell_types = json.load(markers_file)
 
+    if cells is None:
+        cells = read_cells(directory, cache=cache)
+
+    cell_type_counts = cells['cell_type'].value_counts()
+
+    if check:
+        # Needs the cells index loaded and refreshed
+        check_cell_type_counts(cell_type_counts, dashboard_id, host, port)
 
     logger.debug("Processing files")
     records = []
 
     for cell_type_record in cell_types:
-        count = get_cell_type_count(cell_type_record["cell_type"], dashboard_id, host, port)
+        count = int(cell_type_counts.get(cell_type_record["cell_type"], 0))
 
         records.append({
             **cell_type_record,
@@ -57,6 +193,16 @@ def load_rho(directory, dashboard_id, host, port):
     logger.info("LOADED MARKER GENES")
 
 
+def check_cell_type_counts(cell_type_counts, dashboard_id, host, port):
+    indexed_counts = get_cell_type_counts(dashboard_id, host, port)
+
+    for cell_type in sorted(set(cell_type_counts.index) | set(indexed_counts)):
+        [count, indexed_count] = [int(cell_type_counts.get(cell_type, 0)), indexed_counts.get(cell_type, 0)]
+
+        if count != indexed_count:
+            logger.warning(f'{cell_type}: {count} cells in cells.tsv but {indexed_count} indexed')
+
+
 ## Loading metadata for Mira
 def load_dashboard_entry(directory, type, dashboard_id, dashboard_metadata, host, port):
 
@@ -79,19 +225,12 @@ def load_dashboard_entry(directory, type, dashboard_id, dashboard_metadata, host
     logger.info("LOADED DASHBOARD ENTRY")
 
 
-def load_data(directory, dashboard_id, host, port, chunksize=None, metadata={}):
-    logger.info("LOADING DATA: " + dashboard_id)
-
-    logger.debug("Opening files")
-
+def read_cells(directory, cache=True):
     cells_filename = os.path.join(directory, constants.CELLS_FILENAME)
-    genes_filename = os.path.join(directory, constants.GENES_FILENAME)
-    matrix_filename = os.path.join(directory, constants.MATRIX_FILENAME)
     metadata_filename = os.path.join(directory, constants.SAMPLES_FILENAME)
 
-    logger.info("Opening Files at: " + directory)
     logger.info("Opening cell file")
-    cells = pd.read_csv(cells_filename, sep='\t')
+    cells = read_table(cells_filename, cache=cache)
 
     if 'cell_id' not in cells.columns:
         cells.index.name = 'cell_id'
@@ -103,16 +242,8 @@ def load_data(directory, dashboard_id, host, port, chunksize=None, metadata={}):
 
     cells['cell_type'] = cells['cell_type'].str.replace('.', ' ')
 
-    logger.info("Opening genes file")
-    genes = pd.read_csv(genes_filename, sep='\t')
-    genes.index.name = 'gene_idx'
-    genes = genes.reset_index(drop=False)
-    genes = genes.rename(columns={'genes': 'gene'})
-
     # Rows and columns are 1-based
     cells['cell_idx'] += 1
-    genes['gene_idx'] += 1
-
 
     logger.info("Opening metadata file")
     with open(metadata_filename) as samples_file:
@@ -126,6 +257,7 @@ def load_data(directory, dashboard_id, host, port, chunksize=None, metadata={}):
     column_names = list(cells.columns)
     assert 'x' in column_names and 'y' in column_names, 'Missing x and y'
     assert 'cell_id' in column_names, 'Missing cell ID'
+    assert cells['cell_id'].is_unique, 'Duplicate cell IDs'
     assert 'cell_idx' in column_names, 'Missing cell idx'
     assert 'sample_id' in column_names, 'Missing sample ID'
 
@@ -134,297 +266,502 @@ def load_data(directory, dashboard_id, host, port, chunksize=None, metadata={}):
     assert before_cell_count == cells.shape[0]
 
     logger.info("Cells: " + str(cells.shape[0]))
-    logger.info("Genes: " + str(genes.shape[0]))
     logger.info("Samples: " + str(samples.shape[0]))
 
+    return cells
+
+
+def read_genes(directory, cache=True):
+    genes_filename = os.path.join(directory, constants.GENES_FILENAME)
+
+    logger.info("Opening genes file")
+    genes = read_table(genes_filename, cache=cache)
+    genes.index.name = 'gene_idx'
+    genes = genes.reset_index(drop=False)
+    genes = genes.rename(columns={'genes': 'gene'})
+
+    # Rows and columns are 1-based
+    genes['gene_idx'] += 1
+
+    logger.info("Genes: " + str(genes.shape[0]))
+
+    return genes
+
+
+def load_data(directory, dashboard_id, host, port, chunksize=None, metadata={}, cache=True, workers=1, sort_memory=constants.SORT_MEMORY_LIMIT, gene_layout='nested', incremental=False, version=None, checkpoint=None):
+    logger.info("LOADING DATA: " + dashboard_id)
+
+    logger.debug("Opening files")
+
+    matrix_filename = os.path.join(directory, constants.MATRIX_FILENAME)
+
+    logger.info("Opening Files at: " + directory)
+    cells = read_cells(directory, cache=cache)
+    genes = read_genes(directory, cache=cache)
+
+    # Gene bins are summed in the same pass over the matrix as the cell records
+    gene_bins = GeneBins(cells, genes, *get_bin_sizes(cells))
+
+    # Only changed cells are indexed, by cell_id
+    delta = CellDelta(directory, dashboard_id, host, port, version=version) if incremental else None
+
     if chunksize is None:
-        matrix = pd.read_csv(matrix_filename, sep=' ', usecols=[0,1,2], skiprows=1)
+        num_genes, num_cells, num_entries, _ = read_header(matrix_filename)
 
-        assert int(matrix.columns[0]) == genes.shape[0]
-        assert int(matrix.columns[1]) == cells.shape[0]
+        assert num_genes == genes.shape[0]
+        assert num_cells == cells.shape[0]
 
-        matrix.columns = ['gene_idx', 'cell_idx', 'log_count']
-        matrix = matrix.merge(cells[['cell_idx', 'cell_id']])
-        matrix = matrix.merge(genes[['gene_idx', 'gene']])
-        matrix = matrix.merge(samples[['sample_id']])
+        matrix = read_cached_matrix(matrix_filename, cache=cache, sort_memory=sort_memory)
 
-        logger.info(f'Loading {matrix.shape[0]} records with total {cells.shape[0]} cells ({round(cells.shape[0] * 100 / before_cell_count, 2)}%) and {matrix.shape[0]} gene records')
-        
-        load_cells(get_records(cells, matrix), dashboard_id, host, port)
-        return
+        logger.info(f'Loading {matrix.num_entries} records with total {cells.shape[0]} cells (100.0%) and {matrix.num_entries} gene records')
 
-    prev_chunk = None
-    cell_ids = []
-    cell_count = 0
-    num_records = 0
+        records = get_records(cells, genes, matrix, gene_layout=gene_layout)
+        load_cells(records if delta is None else delta.filter(records), dashboard_id, host, port, gene_layout=gene_layout, version=version)
 
-    logger.info("Starting to chunk matrix file")
+        gene_bins.add(matrix.filter(entry_mask=_valid_genes(genes, matrix), column_mask=_valid_cells(cells, matrix)))
 
-    matrix_iter = pd.read_csv(matrix_filename, sep=' ', usecols=[0,1,2], skiprows=1, chunksize=chunksize)
+        if delta is not None:
+            refresh_cells(dashboard_id, host, port, version=version)
+            delta.finish(host, port)
 
-    for matrix_chunk in matrix_iter:
-        total_cells = int(cells.shape[0])
-        total_records = int(matrix_chunk.columns[2])
+        return gene_bins
 
-        matrix_chunk.columns = ['gene_idx', 'cell_idx', 'log_count']
+    # Cells of the matrix stream indexed before the load was interrupted
+    num_done = 0 if checkpoint is None else checkpoint["num_cells"]
 
-        # Need at least 2 cells of data per chunk for correctness of streaming
-        if len(matrix_chunk['cell_idx'].unique()) <= 1:
-            raise ValueError('chunk size set too low')
+    if workers > 1 and incremental:
+        logger.info("Incremental loads stream the matrix in one process")
+    elif workers > 1 and num_done > 0:
+        logger.info("Resumed loads stream the matrix in one process")
+    elif workers > 1:
+        return _load_data_parallel(matrix_filename, cells, genes, gene_bins, dashboard_id, host, port, chunksize, workers, cache, sort_memory, gene_layout, version)
 
-        # Identify the last cell to be read
-        last_cell_idx = matrix_chunk['cell_idx'].values[-1]
+    total_cells = int(cells.shape[0])
+    cell_idxs = []
+    cell_count = 0
+    num_records = 0
+    stream_cells = 0
 
-        matrix_chunk = matrix_chunk.merge(cells[['cell_idx', 'cell_id']])
-        matrix_chunk = matrix_chunk.merge(genes[['gene_idx', 'gene']])
-        # matrix_chunk = matrix_chunk.merge(samples[['sample_id']])
+    logger.info("Starting to chunk matrix file")
 
-        # Split out last cell id data
-        first_cells_chunk = matrix_chunk.loc[matrix_chunk['cell_idx'] != last_cell_idx]
-        last_cell_chunk = matrix_chunk.loc[matrix_chunk['cell_idx'] == last_cell_idx]
+    for matrix_block in iter_cached_blocks(matrix_filename, chunksize, cache=cache, sort_memory=sort_memory):
+        to_index = np.arange(stream_cells, stream_cells + matrix_block.num_cells) >= num_done
+        stream_cells += matrix_block.num_cells
 
-        # Merge previous chunk
-        if prev_chunk is not None:
-            load_chunk = pd.concat([prev_chunk, first_cells_chunk], ignore_index=True)
-        else:
-            load_chunk = first_cells_chunk
+        valid_cells = _valid_cells(cells, matrix_block)
+        matrix_block = matrix_block.filter(entry_mask=_valid_genes(genes, matrix_block), column_mask=valid_cells)
+        to_index = to_index[valid_cells]
 
-        # Set chunk of last cells aside
-        if last_cell_chunk.empty:
-            prev_chunk = None
-        else:
-            prev_chunk = last_cell_chunk
+        gene_bins.add(matrix_block)
 
         # Update for checking later
-        cell_ids.append(load_chunk[['cell_id']].drop_duplicates())
-        cell_count += len(load_chunk['cell_id'].unique())
-        num_records += load_chunk.shape[0]
+        cell_idxs.append(matrix_block.cell_idx)
+        cell_count += matrix_block.num_cells
+        num_records += matrix_block.num_entries
+
+        if not to_index.all():
+            matrix_block = matrix_block.filter(column_mask=to_index)
 
         # Load the data if there are records
-        if load_chunk.shape[0] > 0:
-            logger.info(f'Loading {load_chunk.shape[0]} records with total {cell_count} cells ({round(cell_count * 100/ total_cells, 2)}%) and {num_records} gene records')
-            load_cells(get_records(cells, load_chunk), dashboard_id, host, port)
- 
-    # Clear queue
-    if prev_chunk is not None:
-        cell_ids.append(prev_chunk[['cell_id']].drop_duplicates())
-        num_records += prev_chunk.shape[0]
-        cell_count += len(prev_chunk['cell_id'].unique())
+        if matrix_block.num_entries > 0:
+            logger.info(f'Loading {matrix_block.num_entries} records with total {cell_count} cells ({round(cell_count * 100/ total_cells, 2)}%) and {num_records} gene records')
+            records = get_records(cells, genes, matrix_block, gene_layout=gene_layout)
+            load_cells(records if delta is None else delta.filter(records), dashboard_id, host, port, gene_layout=gene_layout, version=version)
+
+        if checkpoint is not None:
+            # A resumed load would skip cells that failed to index
+            check_dead_letters([get_cells_index(dashboard_id, version)])
 
-        logger.info(f'Loading {prev_chunk.shape[0]} records with total {cell_count} cells ({round(cell_count * 100/ total_cells, 2)}%) and {num_records} gene records')
+            checkpoint["num_cells"] = stream_cells
+            write_checkpoint(_get_checkpoint_filename(directory, dashboard_id), checkpoint)
 
-        # Load the last cell worth of data
-        load_cells(get_records(cells, prev_chunk), dashboard_id, host, port, refresh=True)
+    refresh_cells(dashboard_id, host, port, version=version)
 
+    _check_loaded_cells(total_cells, cell_idxs)
 
-    cell_ids = pd.concat(cell_ids)
+    if delta is not None:
+        delta.finish(host, port)
 
-    if cell_ids['cell_id'].duplicated().any():
+    return gene_bins
+
+
+def _check_loaded_cells(total_cells, cell_idxs):
+    cell_idxs = np.concatenate(cell_idxs) if len(cell_idxs) > 0 else np.zeros(0, dtype=np.int32)
+
+    if pd.Series(cell_idxs).duplicated().any():
         raise ValueError('streaming failed, duplicate cells')
         ## !!! wilL need to eventually delete or something
 
-    num_cells = len(cell_ids['cell_id'].unique())
+    num_cells = np.unique(cell_idxs).shape[0]
     if total_cells != num_cells:
         raise ValueError(f'mismatch in {num_cells} cells loaded to {total_cells} total cells')
 
 
-def get_records(cells, matrix):
+## Dashboards sharing one matrix.mtx (cohort_all and its cell type subsets, whose genes and matrix
+## are links to the cohort's): the matrix is parsed once and each cell is sent to every dashboard
+## that has it in its cells.tsv
+## With cohort_aliases, subset cells are only indexed as part of cohort_all, with their subset fields
+## added as <subset>_x, <subset>_y, <subset>_cluster_label, and subset cells indices are filtered aliases
+def load_shared_analyses(analyses, type, host, port, chunksize=None, cache=True, sparse_bins=False, sort_memory=constants.SORT_MEMORY_LIMIT, gene_layout='nested', cohort_aliases=False, incremental=False, version=None, keep_versions=constants.KEEP_VERSIONS, merge_segments=None):
+    # analyses have dashboard_id, directory and metadata
+    # Returns the error of each dashboard that failed after the shared pass (None for the ones that loaded)
+    dashboard_ids = [analysis["dashboard_id"] for analysis in analyses]
+    logger.info("====================== " + ", ".join(dashboard_ids))
+
+    matrix_filename = os.path.join(analyses[0]["directory"], constants.MATRIX_FILENAME)
+    dashboards = []
+
+    for analysis in analyses:
+        assert os.path.realpath(os.path.join(analysis["directory"], constants.MATRIX_FILENAME)) == os.path.realpath(matrix_filename)
+
+        cells = read_cells(analysis["directory"], cache=cache)
+        genes = read_genes(analysis["directory"], cache=cache)
+
+        dashboards.append({
+            **analysis,
+            "cells": cells,
+            "genes": genes,
+            "gene_bins": GeneBins(cells, genes, *get_bin_sizes(cells)),
+            "cell_idxs": []
+        })
+
+    base = None
+    if cohort_aliases:
+        base = next((dashboard for dashboard in dashboards if dashboard["dashboard_id"] == constants.COHORT_DASHBOARD_ID), None)
+
+        if base is None:
+            logger.info(f'No {constants.COHORT_DASHBOARD_ID} to alias, loading subset cells indices')
+        else:
+            subset_fields = _get_subset_fields([dashboard for dashboard in dashboards if dashboard is not base])
 
+    for dashboard in dashboards:
+        dashboard["has_cells"] = base is None or dashboard is base
 
-    ### !!! remember to remove
-    logger.info(f"matrix before filter: {matrix.shape[0]}")
-    matrix = matrix[matrix["gene_idx"] < 10000]
-    logger.info(f"matrix after filter: {matrix.shape[0]}")
+    # Incremental loads of the group without manifests for every dashboard load all of them in full, as a new version
+    if incremental and version is None and not all(has_manifests(dashboard["directory"], dashboard["dashboard_id"], host, port, cells=dashboard["has_cells"]) for dashboard in dashboards):
+        version = get_new_version()
+        logger.info(f'Loading {", ".join(dashboard_ids)} in full, as version {version}')
 
-    records = []
-    for cell_id, cell_info in matrix.groupby('cell_id'):
-        gene_counts = cell_info[['gene', 'log_count']].to_dict(orient='records')
-        cell_meta = cells.query(f'cell_id == "{cell_id}"')
-        assert cell_meta.shape[0] == 1
-        # cell_record = cell_meta[['cell_id', 'cell_type', 'UMAP-1', 'UMAP-2', 'sample']].iloc[0].to_dict()
-        cell_record = cell_meta[:].iloc[0].to_dict()
-        cell_record['genes'] = gene_counts
+    for dashboard in dashboards:
+        dashboard["delta"] = CellDelta(dashboard["directory"], dashboard["dashboard_id"], host, port, version=version) if incremental and dashboard["has_cells"] else None
 
-        records.append(cell_record)
+    logger.info(f"Streaming {matrix_filename} to {len(dashboards)} dashboards")
 
-    return records
+    num_chunk = 0
+    try:
+        for matrix_block in iter_cached_blocks(matrix_filename, chunksize if chunksize is not None else int(1e6), cache=cache, sort_memory=sort_memory):
+            for dashboard in dashboards:
+                [cells, genes] = [dashboard["cells"], dashboard["genes"]]
+                dashboard_block = matrix_block.filter(entry_mask=_valid_genes(genes, matrix_block), column_mask=_valid_cells(cells, matrix_block))
+
+                dashboard["gene_bins"].add(dashboard_block)
+                dashboard["cell_idxs"].append(dashboard_block.cell_idx)
+
+                # Aliased subsets are indexed with the cohort cells
+                if dashboard_block.num_entries == 0 or (base is not None and dashboard is not base):
+                    continue
+
+                records = get_records(cells, genes, dashboard_block, gene_layout=gene_layout)
+                if dashboard is base:
+                    records = _add_subset_fields(records, subset_fields)
+                if dashboard["delta"] is not None:
+                    records = dashboard["delta"].filter(records)
+
+                load_cells(records, dashboard["dashboard_id"], host, port, gene_layout=gene_layout, version=version)
+
+            num_chunk += 1
+            logger.info(f'Streamed chunk {num_chunk} with {matrix_block.num_cells} cells')
+    except:
+        # No dashboard of the group is loaded, the new version of every one of them goes
+        if version is not None:
+            for dashboard in dashboards:
+                discard_version(dashboard["dashboard_id"], version, host, port)
+        raise
+
+    # Subsets are aliased to the cohort cells once these are checked
+    if base is not None:
+        dashboards = [base] + [dashboard for dashboard in dashboards if dashboard is not base]
+
+    errors = {}
+    for dashboard in dashboards:
+        [dashboard_id, directory, cells] = [dashboard["dashboard_id"], dashboard["directory"], dashboard["cells"]]
+
+        metadata = dashboard["metadata"] if gene_layout == 'nested' else {**dashboard["metadata"], "gene_layout": gene_layout}
+        if sparse_bins:
+            metadata = {**metadata, "sparse_bins": True}
+
+        is_alias = base is not None and dashboard is not base
+
+        try:
+            if is_alias:
+                if errors[base["dashboard_id"]] is not None:
+                    raise ValueError(f'{base["dashboard_id"]} failed to load')
+
+                missing = ~np.isin(cells['cell_idx'].values, base["cells"]['cell_idx'].values)
+                if missing.any():
+                    raise ValueError(f'{missing.sum()} cells of {dashboard_id} are not in {base["dashboard_id"]}')
+
+                create_cells_alias(dashboard_id, base["dashboard_id"], host, port, version=version)
+
+                metadata = {
+                    **metadata,
+                    "cells_alias_of": base["dashboard_id"],
+                    "cell_fields": {field: f'{dashboard_id}_{field}' for field in constants.SUBSET_CELL_FIELDS}
+                }
 
+            refresh_cells(dashboard_id, host, port, version=None if is_alias else version)
+            _check_loaded_cells(int(cells.shape[0]), dashboard["cell_idxs"])
 
-def load_bins(directory, type, dashboard_id, host, port):
-    logger.info("LOAD BINS: " + dashboard_id)
+            if dashboard["delta"] is not None:
+                dashboard["delta"].finish(host, port)
 
-    [x_bin_size, y_bin_size] = get_bin_sizes(dashboard_id, host, port)
-    es = initialize_es(host, port)
-    index = constants.DASHBOARD_DATA_PREFIX + dashboard_id.lower()
+            load_bins(directory, type, dashboard_id, host, port, cache=cache, gene_bins=dashboard["gene_bins"], sparse=sparse_bins, incremental=incremental, version=version)
+            finish_indices(dashboard_id, host, port, version=version, max_num_segments=merge_segments, cells=not is_alias)
 
+            if version is not None:
+                publish_version(dashboard_id, version, host, port, keep_versions=keep_versions)
 
-    logger.info("categorical")
-    categorical_labels = ["cell_type", "surgery", "site", "therapy", "sort", "sample_id"]
+                if not incremental:
+                    delete_manifests(directory, dashboard_id)
 
-    if type == "cohort" and dashboard_id != "cohort_all":
-        categorical_labels.append("cluster_label")
+            if incremental or version is not None:
+                clean_rho(dashboard_id, host, port)
+            load_rho(directory, dashboard_id, host, port, cells=cells)
 
-    data_header = json.dumps({})
-    data_str = ''
-
-    for label in categorical_labels:
-        data_str += data_header + '\n' + json.dumps({"size":0,      "aggs": {
-            "agg_histogram_x": {
-                "histogram": {
-                    "field": "x",
-                    "interval": x_bin_size,
-                    "min_doc_count": 1
-                },
-                "aggs": {
-                    "agg_histogram_y": {
-                    "histogram": {
-                        "field": "y",
-                        "interval": y_bin_size,
-                        "min_doc_count": 1
-                    },
-                    "aggs": {
-                        "agg_cat": {
-                            "terms": {
-                                "field": label,
-                                "size": 1
-                            }
-                        }
-                        
-                    }
-                    }
-                }
-            }
-        }}) + '\n'
-    
-    logger.info("querying")
-    results = es.msearch(index=index, body=data_str)
-    logger.info(f'queries results: {len(results["responses"])}')
-
-    processed_records = []
-    for idx, res_chunk in enumerate(results["responses"]):
-        if 'error' in res_chunk.keys():
-            logger.info(categorical_labels[idx])
-            logger.info(res_chunk['error'])
-        else:
-            for response_x in res_chunk["aggregations"]["agg_histogram_x"]["buckets"]:
-                for response_y in response_x["agg_histogram_y"]["buckets"]:
-                    processed_record = {
-                        "x": round(response_x["key"] / x_bin_size),
-                        "y": round(response_y["key"] / y_bin_size),
-                        "count": response_y["doc_count"],
-                        "label": categorical_labels[idx],
-                        "value": response_y["agg_cat"]["buckets"][0]["key"]
-                    }
+            load_dashboard_entry(directory, type, dashboard_id, metadata, host, port)
 
-                    processed_records.append(processed_record)
+            errors[dashboard_id] = None
+        except Exception as error:
+            logger.exception(f'Failed to load {dashboard_id}')
+            errors[dashboard_id] = error
 
+            if version is not None:
+                discard_version(dashboard_id, version, host, port)
 
+                if incremental:
+                    delete_manifests(directory, dashboard_id)
 
-    logger.info(f'records: {len(processed_records)}')
+    logger.info("Done.")
 
+    return errors
 
-    _load_bins(processed_records, dashboard_id, host, port)
 
-    logger.info("genes")
+def _get_subset_fields(subsets):
+    # Fields each cell_idx gets in the cohort cells index for the subsets it is in
+    subset_fields = {}
 
+    for subset in subsets:
+        dashboard_id = subset["dashboard_id"]
+        fields = [field for field in constants.SUBSET_CELL_FIELDS if field in subset["cells"].columns]
 
-    cells_filename = os.path.join(directory, constants.CELLS_FILENAME)
-    genes_filename = os.path.join(directory, constants.GENES_FILENAME)
-    matrix_filename = os.path.join(directory, constants.MATRIX_FILENAME)
+        for cell_record in subset["cells"][['cell_idx'] + fields].to_dict(orient='records'):
+            cell_fields = subset_fields.setdefault(cell_record['cell_idx'], {constants.SUBSETS_FIELD: []})
+            cell_fields[constants.SUBSETS_FIELD].append(dashboard_id)
 
-    logger.info("Opening Files at: " + directory)
-    logger.info("Opening cell file")
-    cells = pd.read_csv(cells_filename, sep='\t')
+            for field in fields:
+                if pd.notna(cell_record[field]):
+                    cell_fields[f'{dashboard_id}_{field}'] = cell_record[field]
 
-    if 'cell_id' not in cells.columns:
-        cells.index.name = 'cell_id'
-        cells = cells.reset_index(drop=False)
-        
-    if 'cell_idx' not in cells.columns:
-        cells.index.name = 'cell_idx'
-        cells = cells.reset_index(drop=False)
+    return subset_fields
 
-    cells['cell_type'] = cells['cell_type'].str.replace('.', ' ')
-    cells = cells.rename(columns={'sample':'sample_id', 'UMAP-1': 'x', 'UMAP-2': 'y', 'umap50_1': 'x', 'umap50_2': 'y', "UMAP_1": "x", "UMAP_2": "y", "umapharmony_1": 'x', 'umapharmony_2': 'y'})
 
-    cells['x'] = cells['x'] // x_bin_size
-    cells['y'] = cells['y'] // y_bin_size
+def _add_subset_fields(records, subset_fields):
+    for record in records:
+        record.update(subset_fields.get(record['cell_idx'], {constants.SUBSETS_FIELD: []}))
+        yield record
 
-    ## convert to dict???
-    cells['count'] = 0
-    binned_counts = cells[['x', 'y','count']].groupby(['x','y']).count().reset_index().to_dict(orient='record')
 
-    logger.info("Opening genes file")
-    genes = pd.read_csv(genes_filename, sep='\t')
-    genes.index.name = 'gene_idx'
-    genes = genes.reset_index(drop=False)
-    genes = genes.rename(columns={'genes': 'gene'})
+## Tables for partition workers, inherited when the pool forks
+_partition_tables = None
 
-    # Rows and columns are 1-based
-    cells['cell_idx'] += 1
-    genes['gene_idx'] += 1
 
+def _load_data_parallel(matrix_filename, cells, genes, gene_bins, dashboard_id, host, port, chunksize, workers, cache, sort_memory, gene_layout, version):
+    global _partition_tables
 
+    # Several partitions per worker to even out the load
+    num_partitions = workers * 4
 
-    matrix_iter = pd.read_csv(matrix_filename, sep=' ', usecols=[0,1,2], skiprows=1, chunksize=int(1e6))
+    entry_directory = get_cache_entry(matrix_filename) if cache else None
+    cell_index = None
 
-    count_bins = {}
-    for bin_count in binned_counts:
-        key = f"{bin_count['x']}_{bin_count['y']}"
-        count_bins[key] = {'count': bin_count['count']}
+    if entry_directory is None:
+        try:
+            cell_index = get_cell_index(matrix_filename, cache=cache)
+        except NotGroupedError as error:
+            logger.info(f'{error}, sorting it by cell')
+            entry_directory = get_sorted_entry(matrix_filename, max_memory=sort_memory, cache=cache)
 
-    logger.info(f'Bins: {len(count_bins.keys())}')
+    if entry_directory is not None:
+        logger.info(f"Partitioning cached matrix for {workers} workers")
+        partitions = [(matrix_filename, start, end, entry_directory) for [start, end] in load_matrix(entry_directory).get_partitions(num_partitions)]
+    else:
+        logger.info(f"Partitioning matrix file for {workers} workers")
+        partitions = [(matrix_filename, start, end, None) for [start, end] in cell_index.get_partitions(num_partitions)]
 
-    num_chunk = 0
-    for matrix_chunk in matrix_iter:
-        logger.info(f'processing chunk {num_chunk} ')
-        matrix_chunk.columns = ['gene_idx', 'cell_idx', 'log_count']
+    total_cells = int(cells.shape[0])
+    cell_idxs = []
+    cell_count = 0
+    num_records = 0
 
-        matrix_chunk = matrix_chunk.merge(cells[['cell_idx', 'x', 'y']])
-        matrix_chunk = matrix_chunk.merge(genes[['gene_idx', 'gene']])
+    _partition_tables = (cells, genes, cell_index, gene_bins.x_bin_size, gene_bins.y_bin_size)
 
-        counts = matrix_chunk[['gene', 'log_count', 'x', 'y']].to_dict(orient="records")
+    # Created before the workers fork, so they don't race to create it
+    create_cells_index(dashboard_id, host, port, gene_layout=gene_layout, version=version)
 
-        for count in counts:
-            key = f"{count['x']}_{count['y']}"
-            curr_bin = count_bins[key]
-            curr_gene = count['gene']
-            if curr_gene in curr_bin:
-                curr_bin[curr_gene] = curr_bin[curr_gene] + count['log_count']
-            else:
-                curr_bin[curr_gene] = count['log_count']
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_load_partition, partition, chunksize, dashboard_id, host, port, gene_layout, version) for partition in partitions]
 
-            count_bins[key] = curr_bin
+            for future in as_completed(futures):
+                [partition_cell_idxs, partition_records, keys, sums] = future.result()
 
-        num_chunk += 1
+                gene_bins.add_sums(keys, sums)
 
+                cell_idxs.append(partition_cell_idxs)
+                cell_count += partition_cell_idxs.shape[0]
+                num_records += partition_records
 
+                logger.info(f'Loaded partition with total {cell_count} cells ({round(cell_count * 100/ total_cells, 2)}%) and {num_records} gene records')
+    finally:
+        _partition_tables = None
 
-    records = []
-    total_records = 0
+        # Sorted copy made without the cache
+        if entry_directory is not None and not is_cache_entry(entry_directory):
+            shutil.rmtree(entry_directory, ignore_errors=True)
 
-    gene_names = genes['gene'].to_list()
+    refresh_cells(dashboard_id, host, port, version=version)
 
-    for key, counts in count_bins.items():
-        [x, y] = key.split("_")
-        
-        total_count = counts['count']
+    _check_loaded_cells(total_cells, cell_idxs)
+
+    return gene_bins
+
+
+def _load_partition(partition, chunksize, dashboard_id, host, port, gene_layout, version):
+    [cells, genes, cell_index, x_bin_size, y_bin_size] = _partition_tables
+    [matrix_filename, start, end, entry_directory] = partition
+
+    if entry_directory is not None:
+        matrix_blocks = load_matrix(entry_directory).slice(start, end).iter_blocks(chunksize)
+    else:
+        matrix_blocks = iter_cell_blocks(matrix_filename, cell_index, chunksize, start=start, end=end)
+
+    gene_bins = GeneBins(cells, genes, x_bin_size, y_bin_size)
+    cell_idxs = []
+    num_records = 0
+
+    for matrix_block in matrix_blocks:
+        matrix_block = matrix_block.filter(entry_mask=_valid_genes(genes, matrix_block), column_mask=_valid_cells(cells, matrix_block))
+
+        gene_bins.add(matrix_block)
+        cell_idxs.append(matrix_block.cell_idx)
+        num_records += matrix_block.num_entries
+
+        if matrix_block.num_entries > 0:
+            load_cells(get_records(cells, genes, matrix_block, gene_layout=gene_layout), dashboard_id, host, port, gene_layout=gene_layout, version=version)
+
+    cell_idxs = np.concatenate(cell_idxs) if len(cell_idxs) > 0 else np.zeros(0, dtype=np.int32)
+
+    return (cell_idxs, num_records, *gene_bins.get_sums())
+
+
+def _valid_cells(cells, matrix):
+    return np.isin(matrix.cell_idx, cells['cell_idx'].values)
+
+
+def _valid_genes(genes, matrix):
+    return (matrix.gene_idx >= 1) & (matrix.gene_idx <= genes.shape[0])
+
+
+def get_records(cells, genes, matrix, gene_layout='nested'):
 
-        for gene in gene_names:
-            record = {
-                'x': float(x),
-                'y': float(y),
-                'count': total_count,
-                'label': gene,
-                'value': counts[gene] / total_count if gene in counts else 0
-            }
 
-            records.append(record)
+    ### !!! remember to remove
+    logger.info(f"matrix before filter: {matrix.num_entries}")
+    matrix = matrix.filter(entry_mask=matrix.gene_idx < 10000)
+    logger.info(f"matrix after filter: {matrix.num_entries}")
+
+    # Drop entries that have no cell or gene to join to, and cells left without genes
+    matrix = matrix.filter(entry_mask=_valid_genes(genes, matrix), column_mask=_valid_cells(cells, matrix))
+    matrix = matrix.filter(column_mask=np.diff(matrix.indptr) > 0)
+
+    cells_index = pd.Index(cells['cell_idx'])
+    assert cells_index.is_unique
+
+    positions = cells_index.get_indexer(matrix.cell_idx)
+
+    if gene_layout == 'compact':
+        return _iter_compact_records(cells, positions, matrix.indptr, genes['gene'].values, matrix.gene_idx, matrix.log_count)
+
+    return _iter_records(cells, positions, matrix.indptr, genes['gene'].values, matrix.gene_idx, matrix.log_count)
+
+
+def _iter_records(cells, positions, indptr, gene_names, gene_idx, log_counts):
+    cell_records = cells.iloc[positions].to_dict(orient='records')
+
+    for cell_record, start, end in zip(cell_records, indptr[:-1], indptr[1:]):
+        cell_record['genes'] = [{'gene': gene, 'log_count': log_count} for gene, log_count in zip(gene_names[gene_idx[start:end] - 1].tolist(), log_counts[start:end].tolist())]
+
+        yield cell_record
+
+
+def _iter_compact_records(cells, positions, indptr, gene_names, gene_idx, log_counts):
+    # Genes as parallel gene_ids / values arrays (CELLS_COMPACT_INDEX_MAPPING)
+    cell_records = cells.iloc[positions].to_dict(orient='records')
+
+    for cell_record, start, end in zip(cell_records, indptr[:-1], indptr[1:]):
+        cell_record['gene_ids'] = gene_names[gene_idx[start:end] - 1].tolist()
+        cell_record['values'] = log_counts[start:end].tolist()
+
+        yield cell_record
+
+
+def load_bins(directory, type, dashboard_id, host, port, cache=True, gene_bins=None, sparse=False, incremental=False, version=None):
+    logger.info("LOAD BINS: " + dashboard_id)
+
+    if gene_bins is None:
+        gene_bins = get_gene_bins(directory, cache=cache)
+
+    [x_bin_size, y_bin_size] = [gene_bins.x_bin_size, gene_bins.y_bin_size]
+
+
+    logger.info("categorical")
+    categorical_labels = ["cell_type", "surgery", "site", "therapy", "sort", "sample_id"]
+
+    if type == "cohort" and dashboard_id != "cohort_all":
+        categorical_labels.append("cluster_label")
+
+    cells = read_cells(directory, cache=cache)
+    processed_records = get_categorical_bins(cells, categorical_labels, x_bin_size, y_bin_size)
+
+    # Only bins whose records changed are replaced
+    bins = None
+    if incremental:
+        bin_hashes = get_bin_hashes(processed_records, gene_bins, sparse)
+        bins = get_changed_bins(directory, dashboard_id, bin_hashes, host, port, version=version)
+
+        if bins is not None:
+            processed_records = [record for record in processed_records if (float(record['x']), float(record['y'])) in bins]
+
+    logger.info(f'records: {len(processed_records)}')
+
+
+    _load_bins(processed_records, dashboard_id, host, port, version=version)
+
+    logger.info("genes")
+
+    if sparse:
+        logger.info(f'Sparse bins, skipping {gene_bins.get_num_zero_records()} zero gene records')
+
+    records = []
+    total_records = 0
+
+    for record in gene_bins.get_records(sparse=sparse, bins=bins):
+        records.append(record)
 
         if len(records) > int(1e6):
             logger.info(f'Records: {len(records)}')
             logger.info(f'Example record: {records[0]}')
-            _load_bins(records, dashboard_id, host, port)
+            _load_bins(records, dashboard_id, host, port, version=version)
 
             total_records += len(records)
             logger.info(f'Total records: {total_records}')
@@ -434,8 +771,31 @@ def load_bins(directory, type, dashboard_id, host, port):
     if len(records) > 0:
         logger.info(f'Records: {len(records)}')
         logger.info(f'Example record: {records[0]}')
-        _load_bins(records, dashboard_id, host, port, refresh=True)
+        _load_bins(records, dashboard_id, host, port, refresh=True, version=version)
 
         total_records += len(records)
         logger.info(f'Total records: {total_records}')
 
+    if incremental:
+        refresh_bins(dashboard_id, host, port, version=version)
+        write_manifest(directory, constants.DASHBOARD_BINS_PREFIX + dashboard_id.lower(), bin_hashes, host, port, version=version)
+
+
+def get_gene_bins(directory, cache=True):
+    # Separate pass over the matrix, for when bins are loaded without load_data
+    matrix_filename = os.path.join(directory, constants.MATRIX_FILENAME)
+
+    logger.info("Opening Files at: " + directory)
+    cells = read_cells(directory, cache=cache)
+    genes = read_genes(directory, cache=cache)
+
+    gene_bins = GeneBins(cells, genes, *get_bin_sizes(cells))
+
+    num_chunk = 0
+    for matrix_block in iter_cached_blocks(matrix_filename, int(1e6), cache=cache):
+        logger.info(f'processing chunk {num_chunk} ')
+        gene_bins.add(matrix_block.filter(entry_mask=_valid_genes(genes, matrix_block), column_mask=_valid_cells(cells, matrix_block)))
+
+        num_chunk += 1
+
+    return gene_bins
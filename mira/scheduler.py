@@ -0,0 +1,167 @@
+import logging
+import os
+import time
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from mira.mira_loader import load_analysis, load_shared_analyses
+from utils.versions import get_new_version
+from mira.matrix import read_header
+import mira.constants as constants
+
+logger = logging.getLogger('mira_loading')
+
+
+## Loads several dashboards at once, each in its own process
+## Dashboards start biggest first, as long as their estimated memory fits in max_memory
+## (one is always allowed to run). A failed dashboard is reported instead of stopping the others.
+## Dashboards linking to the same matrix.mtx (a cohort and its cell type subsets) are one job
+## that parses the matrix once for all of them.
+## Reloads write a new version of each dashboard's indices, which replaces the live one once loaded.
+
+
+def get_memory_estimate(directory, chunksize=None, workers=1):
+    # Rough peak memory of a load, from the number of matrix entries it holds at once
+    num_genes, num_cells, num_entries, _ = read_header(os.path.join(directory, constants.MATRIX_FILENAME))
+
+    held_entries = num_entries if chunksize is None else min(num_entries, chunksize * workers)
+
+    return held_entries * constants.MEMORY_PER_ENTRY
+
+
+def load_dashboards(analyses, type, host, port, concurrency=1, max_memory=constants.LOAD_MEMORY_LIMIT, reload=False, cohort_aliases=False, **load_options):
+    # analyses have dashboard_id, directory and modified, load_options go to load_analysis
+    jobs = []
+    for group in _group_by_matrix(analyses):
+        try:
+            memory = get_memory_estimate(group[0]["directory"], chunksize=load_options.get("chunksize"), workers=load_options.get("workers", 1))
+            size = os.path.getsize(os.path.join(group[0]["directory"], constants.MATRIX_FILENAME))
+        except (OSError, ValueError) as error:
+            # Left for the load itself to fail and report
+            logger.warning(f'Could not size {group[0]["dashboard_id"]}: {error}')
+            [memory, size] = [0, 0]
+
+        jobs.append((size, memory, group))
+
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    if reload:
+        load_options = {**load_options, "version": get_new_version()}
+
+    logger.info(f'Loading {len(analyses)} dashboards in {len(jobs)} jobs, {concurrency} at a time within {round(max_memory / 1024 ** 3, 2)} GB')
+
+    if concurrency <= 1:
+        report = [status for [_, memory, group] in jobs for status in _load_dashboards(group, memory, type, host, port, cohort_aliases, load_options)]
+    else:
+        report = _load_concurrently(jobs, type, host, port, concurrency, max_memory, cohort_aliases, load_options)
+
+    _log_report(report)
+
+    return report
+
+
+def _load_concurrently(jobs, type, host, port, concurrency, max_memory, cohort_aliases, load_options):
+    report = []
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context('fork')) as executor:
+        while len(jobs) > 0 or len(running) > 0:
+            used_memory = sum(memory for memory, _ in running.values())
+
+            # Strictly in order, so a big dashboard waiting for memory is not starved by smaller ones
+            while len(jobs) > 0 and len(running) < concurrency:
+                [_, memory, group] = jobs[0]
+
+                if len(running) > 0 and used_memory + memory > max_memory:
+                    break
+
+                future = executor.submit(_load_dashboards, group, memory, type, host, port, cohort_aliases, load_options)
+                running[future] = (memory, group)
+                used_memory += memory
+                jobs.pop(0)
+
+                logger.info(f'Started {", ".join(analysis["dashboard_id"] for analysis in group)} ({len(running)} running, {len(jobs)} waiting)')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                [memory, group] = running.pop(future)
+
+                try:
+                    report.extend(future.result())
+                except Exception as error:
+                    # The process itself died (e.g. killed for memory)
+                    report.extend(_get_status(analysis, memory, "failed", None, repr(error)) for analysis in group)
+
+    return report
+
+
+def _group_by_matrix(analyses):
+    groups = {}
+    for analysis in analyses:
+        matrix_filename = os.path.realpath(os.path.join(analysis["directory"], constants.MATRIX_FILENAME))
+        groups.setdefault(matrix_filename, []).append(analysis)
+
+    return list(groups.values())
+
+
+def _load_dashboards(group, memory, type, host, port, cohort_aliases, load_options):
+    if len(group) == 1:
+        return [_load_dashboard(group[0], memory, type, host, port, load_options)]
+
+    start_time = time.time()
+
+    try:
+        # The shared pass streams the matrix in one process, from the start
+        shared_options = {name: value for name, value in load_options.items() if name not in ["workers", "resume"]}
+        shared_analyses = [{**analysis, "metadata": {"date": analysis["modified"]}} for analysis in group]
+
+        errors = load_shared_analyses(shared_analyses, type, host, port, cohort_aliases=cohort_aliases, **shared_options)
+    except Exception as error:
+        logger.exception(f'Failed to load {", ".join(analysis["dashboard_id"] for analysis in group)}')
+        return [_get_status(analysis, memory, "failed", start_time, repr(error)) for analysis in group]
+
+    report = []
+    for analysis in group:
+        error = errors[analysis["dashboard_id"]]
+        report.append(_get_status(analysis, memory, "loaded", start_time) if error is None else _get_status(analysis, memory, "failed", start_time, repr(error)))
+
+    return report
+
+
+def _load_dashboard(analysis, memory, type, host, port, load_options):
+    dashboard_id = analysis["dashboard_id"]
+    start_time = time.time()
+
+    try:
+        load_analysis(analysis["directory"], type, dashboard_id, host, port, metadata={"date": analysis["modified"]}, **load_options)
+    except Exception as error:
+        logger.exception(f'Failed to load {dashboard_id}')
+        return _get_status(analysis, memory, "failed", start_time, repr(error))
+
+    return _get_status(analysis, memory, "loaded", start_time)
+
+
+def _get_status(analysis, memory, status, start_time, error=None):
+    return {
+        "dashboard_id": analysis["dashboard_id"],
+        "status": status,
+        "estimated_memory_gb": round(memory / 1024 ** 3, 2),
+        "start": None if start_time is None else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)),
+        "seconds": None if start_time is None else round(time.time() - start_time, 1),
+        "error": error
+    }
+
+
+def _log_report(report):
+    for status in report:
+        logger.info(f'{status["dashboard_id"]}: {status["status"]} in {status["seconds"]}s' + ('' if status["error"] is None else f' ({status["error"]})'))
+
+    num_failed = sum(status["status"] == "failed" for status in report)
+    logger.info(f'Loaded {len(report) - num_failed} of {len(report)} dashboards, {num_failed} failed')
+
+
+def write_report(report, filename):
+    pd.DataFrame(report, columns=["dashboard_id", "status", "estimated_memory_gb", "start", "seconds", "error"]).to_csv(filename, sep='\t', index=False)
+    logger.info(f'Wrote load report to {filename}')
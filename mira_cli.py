@@ -2,12 +2,21 @@ import click
 import logging
 import logging.handlers
 import os
+import time
 
 from mira.mira_loader import load_analysis as _load_analysis, load_dashboard_entry as _load_dashboard_entry, load_bins as _load_bins
 from mira.mira_isabl import get_new_isabl_analyses
 from mira.mira_data import download_analyses_data, get_celltype_analyses, download_metadata
-from mira.elasticsearch import clean_analysis as _clean_analysis, load_rho as _load_rho, clean_rho as _clean_rho, clean_dashboard_entry, clean_genes as _clean_genes
+from mira.elasticsearch import clean_analysis as _clean_analysis, replay_failed as _replay_failed, load_rho as _load_rho, clean_rho as _clean_rho, clean_dashboard_entry, clean_genes as _clean_genes
 from mira.gene_loader import load_gene_names as _load_genes
+from mira.cache import prune_cache as _prune_cache
+from mira.scheduler import load_dashboards, write_report
+from mira.benchmark import benchmark_gene_layouts, benchmark_bulk_paths
+from utils.versions import get_new_version
+from utils.dead_letter import set_dead_letter_file, log_dead_letter_summary
+from utils.es_client import set_http_compress
+from utils.ndjson import set_encode_processes
+import mira.constants as constants
 
 LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
 
@@ -16,8 +25,11 @@ LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(funcName)s - %(message)s"
 @click.option('--host', default='localhost', help='Hostname for Elasticsearch server')
 @click.option('--port', default=9200, help='Port for Elasticsearch server')
 @click.option('--debug', is_flag=True, help='Turn on debugging logs')
+@click.option('--dead-letter-file', help='Where to write documents that failed to index, defaults to a new file in logs/', default=None)
+@click.option('--http-compress', is_flag=True, help='Gzip bulk request bodies')
+@click.option('--encode-processes', help='Number of processes encoding bulk requests, 0 to encode in the loading process', type=int, default=0)
 @click.pass_context
-def main(ctx, host, port, debug):
+def main(ctx, host, port, debug, dead_letter_file, http_compress, encode_processes):
     ctx.obj['host'] = host
     ctx.obj['port'] = port
 
@@ -36,18 +48,38 @@ def main(ctx, host, port, debug):
 
     ctx.obj['logger'] = logger
 
+    ctx.obj['dead_letter_file'] = dead_letter_file if dead_letter_file is not None else time.strftime('logs/failed_documents_%Y-%m-%d_%H%M%S.ndjson')
+    set_dead_letter_file(ctx.obj['dead_letter_file'])
+
+    set_http_compress(http_compress)
+    set_encode_processes(encode_processes)
+
 
 @main.command()
 @click.argument('data_directory')
 @click.pass_context
 @click.option('--type', required=True, type=click.Choice(['patient','cohort'], case_sensitive=False), help="Type of dashboard")
 @click.option('--id', help="ID of dashboard")
-@click.option('--reload', is_flag=True, help="Force reload this library")
+@click.option('--reload', is_flag=True, help="Reload into new indices, that replace the live ones once loaded")
+@click.option('--keep-versions', help="Number of versions of reloaded indices to keep, the live one included", type=int, default=constants.KEEP_VERSIONS)
+@click.option('--incremental', is_flag=True, help="Only index documents that changed since the last load, and delete the ones that are gone")
+@click.option('--resume', is_flag=True, help="Resume an interrupted load from its checkpoint")
 @click.option('--chunksize', help="How many milions of records to chunk matrix file", type=int, default=1)
 @click.option('--download',  is_flag=True,help="Download file if missing", type=int)
 @click.option('--load-new', is_flag=True, help="Load dashboards not currently in Mira")
 @click.option('--load-cohort', type=click.Choice(['cohort','cell_type', 'both']), help="Load cohort, cell types, or both")
-def load_analyses(ctx, data_directory, type,id,  reload, chunksize, download, load_new, load_cohort):
+@click.option('--no-cache', is_flag=True, help="Do not read or write the binary cache of parsed files")
+@click.option('--cache-size', help="Maximum size of the binary cache in GB", type=float, default=200)
+@click.option('--sparse-bins', is_flag=True, help="Only load non-zero gene bins, plus a total count record per bin")
+@click.option('--workers', help="Number of processes building cell records", type=int, default=1)
+@click.option('--sort-memory', help="Memory in GB for sorting matrix files that are not grouped by cell", type=float, default=4)
+@click.option('--gene-layout', type=click.Choice(constants.GENE_LAYOUTS), default='nested', help="Genes of cell records as nested objects or compact gene_ids / values arrays")
+@click.option('--merge-segments', help="Force merge loaded indices down to this many segments", type=int, default=None)
+@click.option('--dashboards', help="Number of dashboards loaded at once", type=int, default=1)
+@click.option('--cohort-aliases', is_flag=True, help="Index cohort subset cells once, in cohort_all, with subset cells indices as filtered aliases")
+@click.option('--max-memory', help="Estimated memory in GB that dashboards loading at once may use together", type=float, default=64)
+@click.option('--report', help="Where to write the per-dashboard status and timing report", default=None)
+def load_analyses(ctx, data_directory, type,id,  reload, keep_versions, incremental, resume, chunksize, download, load_new, load_cohort, no_cache, cache_size, sparse_bins, workers, sort_memory, gene_layout, merge_segments, dashboards, cohort_aliases, max_memory, report):
     assert id is not None or load_new
 
     es_host = ctx.obj['host']
@@ -77,15 +109,18 @@ def load_analyses(ctx, data_directory, type,id,  reload, chunksize, download, lo
 
     analyses = [{**analysis, "directory": data_directory if data_directory.endswith(analysis["dashboard_id"]) else os.path.join(data_directory, analysis["dashboard_id"]) } for analysis in analyses_metadata]
 
-    for analysis in analyses:
-        metadata = {
-            "date": analysis["modified"]
-        }
+    load_report = load_dashboards(analyses, type, es_host, es_port, concurrency=dashboards, max_memory=max_memory * 1024 ** 3, reload=reload, cohort_aliases=cohort_aliases,
+                                  chunksize=chunksize * int(1e6), cache=not no_cache, sparse_bins=sparse_bins, workers=workers, sort_memory=sort_memory * 1024 ** 3, gene_layout=gene_layout, incremental=incremental, resume=resume, keep_versions=keep_versions, merge_segments=merge_segments)
 
-        if reload:
-            _clean_analysis(analysis["dashboard_id"], host=es_host, port=es_port)
+    write_report(load_report, report if report is not None else time.strftime('logs/load_report_%Y-%m-%d_%H%M%S.tsv'))
+    log_dead_letter_summary(logger=ctx.obj['logger'])
 
-        _load_analysis(analysis["directory"], type, analysis["dashboard_id"], es_host, es_port, chunksize=chunksize * int(1e6), metadata=metadata)
+    if not no_cache:
+        _prune_cache(data_directory, max_size=cache_size * 1024 ** 3)
+
+    failed = [status["dashboard_id"] for status in load_report if status["status"] == "failed"]
+    if len(failed) > 0:
+        raise click.ClickException(f'{len(failed)} dashboards failed to load: {", ".join(failed)}')
 
 
 
@@ -94,16 +129,65 @@ def load_analyses(ctx, data_directory, type,id,  reload, chunksize, download, lo
 @click.pass_context
 @click.option('--type', help="Type of dashboard")
 @click.option('--id', help="ID of dashboard")
-@click.option('--reload', is_flag=True, help="Force reload this library")
+@click.option('--reload', is_flag=True, help="Reload into new indices, that replace the live ones once loaded")
+@click.option('--keep-versions', help="Number of versions of reloaded indices to keep, the live one included", type=int, default=constants.KEEP_VERSIONS)
+@click.option('--incremental', is_flag=True, help="Only index documents that changed since the last load, and delete the ones that are gone")
+@click.option('--resume', is_flag=True, help="Resume an interrupted load from its checkpoint")
 @click.option('--chunksize', help="How many milions of records to chunk matrix file", type=int, default=1)
-def load_analysis(ctx, data_directory, type,id,  reload, chunksize):
+@click.option('--no-cache', is_flag=True, help="Do not read or write the binary cache of parsed files")
+@click.option('--cache-size', help="Maximum size of the binary cache in GB", type=float, default=200)
+@click.option('--sparse-bins', is_flag=True, help="Only load non-zero gene bins, plus a total count record per bin")
+@click.option('--workers', help="Number of processes building cell records", type=int, default=1)
+@click.option('--sort-memory', help="Memory in GB for sorting matrix files that are not grouped by cell", type=float, default=4)
+@click.option('--gene-layout', type=click.Choice(constants.GENE_LAYOUTS), default='nested', help="Genes of cell records as nested objects or compact gene_ids / values arrays")
+@click.option('--merge-segments', help="Force merge loaded indices down to this many segments", type=int, default=None)
+def load_analysis(ctx, data_directory, type,id,  reload, keep_versions, incremental, resume, chunksize, no_cache, cache_size, sparse_bins, workers, sort_memory, gene_layout, merge_segments):
     es_host = ctx.obj['host']
     es_port = ctx.obj["port"]
 
-    if reload:
-        _clean_analysis(id, host=es_host, port=es_port)
+    _load_analysis(data_directory, type, id, es_host, es_port, chunksize=chunksize * int(1e6), cache=not no_cache, sparse_bins=sparse_bins, workers=workers, sort_memory=sort_memory * 1024 ** 3, gene_layout=gene_layout, incremental=incremental, resume=resume,
+                   version=get_new_version() if reload else None, keep_versions=keep_versions, merge_segments=merge_segments)
+
+    log_dead_letter_summary(logger=ctx.obj['logger'])
+
+    if not no_cache:
+        _prune_cache(data_directory, max_size=cache_size * 1024 ** 3)
+
 
-    _load_analysis(data_directory, type, id, es_host, es_port, chunksize=chunksize * int(1e6))
+@main.command()
+@click.argument('dead_letter_file')
+@click.pass_context
+def replay_failed(ctx, dead_letter_file):
+    _replay_failed(dead_letter_file, ctx.obj['host'], ctx.obj['port'])
+
+    log_dead_letter_summary(logger=ctx.obj['logger'])
+
+
+@main.command()
+@click.argument('data_directory')
+@click.option('--max-size', help="Size in GB to shrink the binary cache to, least recently used first", type=float, default=200)
+@click.pass_context
+def prune_cache(ctx, data_directory, max_size):
+    _prune_cache(data_directory, max_size=max_size * 1024 ** 3)
+
+
+@main.command()
+@click.argument('data_directory')
+@click.option('--cells', help="Number of cells to load for each layout", type=int, default=5000)
+@click.option('--no-cache', is_flag=True, help="Do not read or write the binary cache of parsed files")
+@click.pass_context
+def benchmark_gene_layout(ctx, data_directory, cells, no_cache):
+    benchmark_gene_layouts(data_directory, ctx.obj['host'], ctx.obj['port'], num_cells=cells, cache=not no_cache)
+
+
+@main.command()
+@click.argument('data_directory')
+@click.option('--cells', help="Number of cells to load for each path", type=int, default=5000)
+@click.option('--encode-processes', help="Number of encoding processes of the paths that use them", type=int, default=4)
+@click.option('--no-cache', is_flag=True, help="Do not read or write the binary cache of parsed files")
+@click.pass_context
+def benchmark_bulk(ctx, data_directory, cells, encode_processes, no_cache):
+    benchmark_bulk_paths(data_directory, ctx.obj['host'], ctx.obj['port'], num_cells=cells, cache=not no_cache, encode_processes=encode_processes)
 
 
 @main.command()
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+
+
+## Bulk request size and concurrency, tuned while loading
+## Requests are sized in bytes of the body, since documents range from a few numbers to whole gene arrays.
+## Every few requests the docs/s of the last window is compared with the one before: a step (more requests
+## in flight, or bigger requests) that made it slower is undone and the other setting is tried instead.
+## Rejections (429 and the like) always back off, concurrency first, and long requests make bodies smaller.
+
+MB = 1024 * 1024
+
+
+class BulkTuner():
+
+    def __init__(self, chunk_bytes=5 * MB, concurrency=4, min_bytes=MB // 4, max_bytes=20 * MB, max_concurrency=16,
+                 window=8, max_latency=30, hold_windows=10, logger=logging.getLogger(__name__)):
+        self.chunk_bytes = chunk_bytes
+        self.concurrency = concurrency
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_concurrency = max_concurrency
+        self.window = window
+        self.max_latency = max_latency
+        self.hold_windows = hold_windows
+        self.logger = logger
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.samples = []
+
+        # Hill climbing state: the setting being stepped, the last step (setting, old value) and the rate before it
+        self.knob = 'concurrency'
+        self.last_step = None
+        self.last_rate = None
+        self.num_undone = 0
+        self.hold = 0
+
+    def acquire(self):
+        # Blocks until fewer than concurrency requests are in flight, returns the start time for release
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+
+        return time.time()
+
+    def release(self, start, num_docs, num_bytes, num_rejected):
+        with self.condition:
+            self.in_flight -= 1
+            self.samples.append((start, time.time(), num_docs, num_bytes, num_rejected))
+
+            if len(self.samples) >= self.window:
+                self.tune(self.samples)
+                self.samples = []
+
+            self.condition.notify_all()
+
+    def get_summary(self):
+        return f'{round(self.chunk_bytes / MB, 2)}MB requests, {self.concurrency} in flight'
+
+    def set(self, knob, value, reason, level=logging.DEBUG):
+        previous = getattr(self, knob)
+        setattr(self, knob, value)
+
+        if value != previous:
+            self.logger.log(level, f'Bulk {knob} {previous} -> {value} ({reason}), now {self.get_summary()}')
+
+        return previous
+
+    def tune(self, samples):
+        elapsed = max(end for _, end, _, _, _ in samples) - min(start for start, _, _, _, _ in samples)
+        rate = sum(num_docs for _, _, num_docs, _, _ in samples) / max(elapsed, 1e-6)
+        latency = max(end - start for start, end, _, _, _ in samples)
+        num_rejected = sum(num_rejected for _, _, _, _, num_rejected in samples)
+
+        # Back off from anything that rejects documents, and start measuring again from there
+        if num_rejected > 0:
+            if self.concurrency > 1:
+                self.set('concurrency', max(1, self.concurrency // 2), f'{num_rejected} documents rejected', level=logging.INFO)
+            else:
+                self.set('chunk_bytes', max(self.min_bytes, self.chunk_bytes // 2), f'{num_rejected} documents rejected', level=logging.INFO)
+            self.reset()
+            return
+
+        if latency > self.max_latency:
+            self.set('chunk_bytes', max(self.min_bytes, self.chunk_bytes // 2), f'requests took up to {round(latency, 1)}s', level=logging.INFO)
+            self.reset()
+            return
+
+        if self.hold > 0:
+            self.hold -= 1
+            return
+
+        # Undo a step that made loading slower, and try the other setting next
+        if self.last_step is not None and rate < self.last_rate * 0.95:
+            [knob, value] = self.last_step
+            self.set(knob, value, f'{round(rate)} docs/s, was {round(self.last_rate)}')
+            self.switch_knob()
+            self.last_step = None
+            self.last_rate = None
+
+            # Neither setting helps any more, stay here for a while
+            self.num_undone += 1
+            if self.num_undone >= 2:
+                self.num_undone = 0
+                self.hold = self.hold_windows
+            return
+
+        if self.last_step is not None:
+            self.num_undone = 0
+
+        if not self.can_step():
+            self.switch_knob()
+            if not self.can_step():
+                return
+
+        if self.knob == 'concurrency':
+            self.last_step = (self.knob, self.set('concurrency', self.concurrency + 1, f'{round(rate)} docs/s'))
+        else:
+            self.last_step = (self.knob, self.set('chunk_bytes', min(self.max_bytes, int(self.chunk_bytes * 1.5)), f'{round(rate)} docs/s'))
+        self.last_rate = rate
+
+    def can_step(self):
+        if self.knob == 'concurrency':
+            return self.concurrency < self.max_concurrency
+
+        return self.chunk_bytes < self.max_bytes
+
+    def switch_knob(self):
+        self.knob = 'chunk_bytes' if self.knob == 'concurrency' else 'concurrency'
+
+    def reset(self):
+        self.knob = 'concurrency'
+        self.last_step = None
+        self.last_rate = None
+        self.num_undone = 0
+        self.hold = 0
+
+
+## One tuner per process, so what was learnt loading one index carries over to the next
+## A forked load worker starts its own, its parent's counts the parent's requests in flight (and may have its lock held)
+
+_tuner = None
+_tuner_lock = threading.Lock()
+
+
+def get_tuner(logger=logging.getLogger(__name__)):
+    global _tuner
+    with _tuner_lock:
+        if _tuner is None or _tuner[0] != os.getpid():
+            _tuner = (os.getpid(), BulkTuner(logger=logger))
+
+        return _tuner[1]
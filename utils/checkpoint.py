@@ -0,0 +1,27 @@
+import json
+import os
+
+
+## Checkpoints of long loads, small JSON files written after every acknowledged batch
+## A checkpoint is replaced with a rename, so it is never left half written.
+
+def read_checkpoint(filename):
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def write_checkpoint(filename, checkpoint):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+    with open(filename + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+
+    os.replace(filename + '.tmp', filename)
+
+
+def delete_checkpoint(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,105 @@
+import collections
+import json
+import logging
+import os
+
+
+## Dead letters: bulk items that still failed after their retries
+## Each is one NDJSON line with the index, the bulk action, the document source and the error,
+## so they can be sent again later with replay_dead_letters.
+## The file is set once per run (by the CLI) and appended to by every process of the run.
+## A file given again by a later run is appended to, so the run's own dead letters are the ones after its start offset.
+## Indices with dead letters of the run are not published or checkpointed past: what they are missing would go live.
+
+_dead_letter_file = None
+_dead_letter_start = 0
+
+
+def set_dead_letter_file(filename):
+    global _dead_letter_file, _dead_letter_start
+    _dead_letter_file = filename
+    _dead_letter_start = os.path.getsize(filename) if filename is not None and os.path.exists(filename) else 0
+
+
+def get_dead_letter_file():
+    return _dead_letter_file
+
+
+def write_dead_letters(filename, dead_letters):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+    # One appending write, so lines from concurrent loads don't interleave
+    lines = ''.join(json.dumps(dead_letter, default=str) + '\n' for dead_letter in dead_letters)
+
+    file_descriptor = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(file_descriptor, lines.encode())
+    finally:
+        os.close(file_descriptor)
+
+
+def read_dead_letters(filename, start=0):
+    # start is a byte offset, lines are read as bytes so it can be sought to
+    with open(filename, 'rb') as dead_letter_file:
+        dead_letter_file.seek(start)
+
+        for line in dead_letter_file:
+            if line.strip() != b'':
+                yield json.loads(line)
+
+
+def count_dead_letters(filename, start=0):
+    if filename is None or not os.path.exists(filename):
+        return collections.Counter()
+
+    return collections.Counter(dead_letter['index'] for dead_letter in read_dead_letters(filename, start=start))
+
+
+def get_run_dead_letters():
+    # Dead letters of this run by index, from every process of the run
+    return count_dead_letters(_dead_letter_file, start=_dead_letter_start)
+
+
+def check_dead_letters(index_names):
+    counts = get_run_dead_letters()
+    num_failed = sum(counts[index_name] for index_name in index_names)
+
+    if num_failed > 0:
+        raise ValueError(f'{num_failed} documents failed to index into {", ".join(index_names)}, they are in {_dead_letter_file}')
+
+
+def log_dead_letter_summary(logger=logging.getLogger(__name__)):
+    counts = get_run_dead_letters()
+
+    if len(counts) == 0:
+        logger.info('No documents failed to index')
+        return
+
+    for index, count in sorted(counts.items()):
+        logger.warning(f'{index}: {count} documents failed to index')
+
+    logger.warning(f'{sum(counts.values())} failed documents are in {_dead_letter_file}, send them again with replay-failed')
+
+
+def replay_dead_letters(es, filename, bulk, logger=logging.getLogger(__name__)):
+    # bulk(es, records, index_name) sends the records of one index, documents that fail again are dead letters of this run
+    records = collections.defaultdict(list)
+
+    for dead_letter in read_dead_letters(filename):
+        [[op_type, action]] = dead_letter['action'].items()
+        records[dead_letter['index']].append({**(dead_letter['source'] or {}), **action, '_op_type': op_type})
+
+    num_sent = 0
+    for index_name, index_records in records.items():
+        # Replays go to the index the documents were meant for, an index that is gone is not created again
+        if not es.indices.exists(index_name):
+            logger.warning(f'{index_name} no longer exists, skipping its {len(index_records)} documents')
+            continue
+
+        logger.info(f'Sending {len(index_records)} documents to {index_name} again')
+        bulk(es, index_records, index_name)
+        es.indices.refresh(index=index_name)
+
+        num_sent += len(index_records)
+
+    return num_sent
@@ -1,5 +1,5 @@
-from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from utils.es_client import get_client
 
 import types
 
@@ -58,10 +58,7 @@ class ElasticsearchClient():
     # TODO: host + port variables
 
     def __init__(self, host='localhost', port=9200):
-        es = Elasticsearch(
-            hosts=[{'host': host, 'port': port}], retry_on_timeout=True)
-
-        self.es = es
+        self.es = get_client(host, port, retry_on_timeout=True)
 
     # TODO: add settings
     def create_index(self, index):
@@ -0,0 +1,97 @@
+from elasticsearch import Elasticsearch
+from elasticsearch.client.indices import IndicesClient
+from elasticsearch.connection import Urllib3HttpConnection
+from urllib3.connection import HTTPConnection
+
+import os
+import socket
+import threading
+
+
+## One Elasticsearch client per cluster and process, shared by every call of a run
+## Connections are pooled (maxsize per node, enough for every bulk sender and the calls around them)
+## and kept alive, so TLS handshakes and authentication are paid once per connection, not once per call.
+## Clients are per process, since a forked worker must not share its parent's sockets.
+## Indices found to exist are remembered until the client deletes an index or changes aliases.
+## Indices deleted by another process are not noticed, which loads don't do to each other's indices.
+## Request bodies are gzipped if http_compress is set (by the CLI), which pays off on slow links to the cluster.
+
+MAXSIZE = 32
+
+
+class KeepAliveConnection(Urllib3HttpConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # TCP keep-alive, so idle pooled connections aren't silently dropped between batches
+        self.pool.conn_kw['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+class CachedIndicesClient(IndicesClient):
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.existing = set()
+        self.lock = threading.Lock()
+
+    def exists(self, index, *args, **kwargs):
+        key = index if isinstance(index, str) else ','.join(index)
+
+        with self.lock:
+            if key in self.existing:
+                return True
+
+        exists = super().exists(index, *args, **kwargs)
+
+        if exists:
+            with self.lock:
+                self.existing.add(key)
+
+        return exists
+
+    def forget(self):
+        with self.lock:
+            self.existing.clear()
+
+    def delete(self, *args, **kwargs):
+        self.forget()
+        return super().delete(*args, **kwargs)
+
+    def delete_alias(self, *args, **kwargs):
+        self.forget()
+        return super().delete_alias(*args, **kwargs)
+
+    def update_aliases(self, *args, **kwargs):
+        # Alias actions can remove indices too
+        self.forget()
+        return super().update_aliases(*args, **kwargs)
+
+
+class PooledElasticsearch(Elasticsearch):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.indices = CachedIndicesClient(self)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_http_compress = False
+
+
+def set_http_compress(http_compress):
+    global _http_compress
+    _http_compress = http_compress
+
+
+def get_client(host, port, maxsize=MAXSIZE, **options):
+    options = {'http_compress': _http_compress, **options}
+    key = (os.getpid(), host, port, maxsize, tuple(sorted(options.items())))
+
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = PooledElasticsearch(hosts=[{'host': host, 'port': port}], connection_class=KeepAliveConnection,
+                                                maxsize=maxsize, **options)
+
+        return _clients[key]
@@ -0,0 +1,42 @@
+import logging
+import time
+
+
+## Index settings for bulk loading, swapped for the serving settings once the load is done
+## While loading there are no replicas (copied once at the end instead of indexing every document twice),
+## no refreshes, and the translog is synced in the background and flushed less often.
+## Serving settings are the index defaults, so refresh and replicas are back to what the cluster uses.
+
+LOADING_SETTINGS = {
+    "number_of_replicas": 0,
+    "refresh_interval": "-1",
+    "translog.durability": "async",
+    "translog.flush_threshold_size": "2gb"
+}
+
+
+def get_loading_mapping(mapping):
+    settings = mapping.get("settings", {})
+
+    return {**mapping, "settings": {**settings, "index": {**settings.get("index", {}), **LOADING_SETTINGS}}}
+
+
+def apply_serving_settings(es, index, max_num_segments=None, logger=logging.getLogger(__name__)):
+    settings = next(iter(es.indices.get_settings(index=index).values()))["settings"]["index"]
+    logger.info(f'{index}: created {round(time.time() - int(settings["creation_date"]) / 1000, 1)}s ago, loading done')
+
+    start = time.time()
+    es.indices.refresh(index=index)
+    logger.info(f'{index}: refreshed in {round(time.time() - start, 1)}s')
+
+    # Merged before replicas are added, so they copy the merged segments
+    if max_num_segments is not None:
+        start = time.time()
+        es.indices.forcemerge(index=index, max_num_segments=max_num_segments, request_timeout=3600)
+        logger.info(f'{index}: merged to {max_num_segments} segments in {round(time.time() - start, 1)}s')
+
+    start = time.time()
+    es.indices.put_settings(index=index, body={
+        "index": {setting: None for setting in LOADING_SETTINGS}
+    })
+    logger.info(f'{index}: serving settings applied in {round(time.time() - start, 1)}s')
@@ -0,0 +1,104 @@
+from concurrent.futures import ProcessPoolExecutor
+from elasticsearch import helpers
+
+import datetime
+import decimal
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+## Bulk lines encoded straight to bytes, with orjson when it is installed and the standard library otherwise
+## NumPy scalars and arrays are written as plain numbers and lists either way, so records can keep them.
+## NaN and infinities are written as NaN and Infinity, and NaT as "NaT", as the client serializer did. orjson writes
+## non-finite floats as null, so documents with a null are encoded again with the standard library.
+## Encoding can run in worker processes, so large documents (cells with thousands of genes) are encoded
+## outside the GIL of the process that sends them.
+
+
+def _default(value):
+    if isinstance(value, np.datetime64):
+        return 'NaT' if np.isnat(value) else value.astype('datetime64[us]').item().isoformat()
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    # pandas NaT is a datetime too, and formats as NaT
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+
+    if isinstance(value, uuid.UUID):
+        return str(value)
+
+    raise TypeError(f'Unable to serialize {value!r} (type: {type(value)})')
+
+
+def dumps(value):
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(value, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # Values orjson has no encoding for, such as NumPy NaT
+            encoded = None
+
+        if encoded is not None and b'null' not in encoded:
+            return encoded
+
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def encode_bulk_lines(records):
+    lines = []
+    for record in records:
+        [action, data] = helpers.expand_action(record)
+        lines.append((dumps(action), None if data is None else dumps(data)))
+
+    return lines
+
+
+## Encoding processes, one pool per process and run, set once (by the CLI)
+## Pools are started with spawn, since the bulk pipeline's threads are running when the first one is needed.
+
+_encode_processes = 0
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+
+def set_encode_processes(num_processes):
+    global _encode_processes
+    _encode_processes = num_processes
+
+
+def get_encode_processes():
+    return _encode_processes
+
+
+def get_encode_pool():
+    global _encode_pool
+    if _encode_processes == 0:
+        return None
+
+    with _encode_pool_lock:
+        # A forked load worker starts its own pool, its parent's belongs to the parent
+        if _encode_pool is None or _encode_pool[0] != os.getpid() or _encode_pool[1] != _encode_processes:
+            if _encode_pool is not None and _encode_pool[0] == os.getpid():
+                _encode_pool[2].shutdown()
+
+            _encode_pool = (os.getpid(), _encode_processes, ProcessPoolExecutor(max_workers=_encode_processes, mp_context=multiprocessing.get_context('spawn')))
+
+        return _encode_pool[2]
@@ -0,0 +1,343 @@
+import inspect
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import TransportError
+from utils.bulk_tuner import get_tuner
+from utils.dead_letter import write_dead_letters
+from utils.ndjson import encode_bulk_lines, get_encode_pool, get_encode_processes
+
+
+## Threaded stages connected by bounded queues
+## The caller's thread feeds the first queue from the source and blocks when it is full,
+## so a slow stage holds back the ones before it instead of letting memory grow.
+## Queue stats show the bottleneck: the stage after a queue that stays full is the slow one,
+## a queue that stays empty means the stages before it can't keep up.
+
+_DONE = object()
+
+# How often blocked puts and gets check whether another stage failed
+_POLL_INTERVAL = 0.5
+
+
+class QueueStats():
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.num_items = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.put_wait = 0.
+        self.get_wait = 0.
+        self.lock = threading.Lock()
+
+    def record_put(self, depth, wait):
+        with self.lock:
+            self.num_items += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+            self.put_wait += wait
+
+    def record_get(self, wait):
+        with self.lock:
+            self.get_wait += wait
+
+    def get_summary(self):
+        average_depth = self.depth_total / self.num_items if self.num_items > 0 else 0
+
+        return (f'{self.name}: {self.num_items} items, depth avg {round(average_depth, 1)} / max {self.max_depth} of {self.maxsize}, '
+                f'producers blocked {round(self.put_wait, 1)}s, consumers waited {round(self.get_wait, 1)}s')
+
+
+class _Pipeline():
+
+    def __init__(self, stages, queue_size):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stats = [QueueStats(f'to {stage[0]}', queue_size) for stage in stages]
+        self.busy = [0.] * len(stages)
+        self.remaining = [stage[2] for stage in stages]
+        self.results = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+
+    def put(self, stage, item):
+        start = time.time()
+        while True:
+            if self.failed.is_set():
+                raise _Aborted()
+            try:
+                self.queues[stage].put(item, timeout=_POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+
+        if item is not _DONE:
+            self.stats[stage].record_put(self.queues[stage].qsize(), time.time() - start)
+
+    def get(self, stage):
+        start = time.time()
+        while True:
+            if self.failed.is_set():
+                raise _Aborted()
+            try:
+                item = self.queues[stage].get(timeout=_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                continue
+
+        self.stats[stage].record_get(time.time() - start)
+        return item
+
+    def forward(self, stage, output):
+        if output is None:
+            return
+
+        if stage + 1 < len(self.stages):
+            self.put(stage + 1, output)
+        else:
+            with self.lock:
+                self.results.append(output)
+
+    def run_stage(self, stage):
+        [function, flush] = [self.stages[stage][1], self.stages[stage][3] if len(self.stages[stage]) > 3 else None]
+        try:
+            while True:
+                item = self.get(stage)
+                if item is _DONE:
+                    break
+
+                start = time.time()
+                if inspect.isgeneratorfunction(function):
+                    # Time spent blocked on the next stage's queue counts as busy for generator stages
+                    for output in function(item):
+                        self.forward(stage, output)
+                else:
+                    self.forward(stage, function(item))
+                with self.lock:
+                    self.busy[stage] += time.time() - start
+
+            if flush is not None:
+                self.forward(stage, flush())
+
+            # Last thread of the stage tells every thread of the next one that it is done
+            with self.lock:
+                self.remaining[stage] -= 1
+                is_last = self.remaining[stage] == 0
+
+            if is_last and stage + 1 < len(self.stages):
+                for _ in range(self.stages[stage + 1][2]):
+                    self.put(stage + 1, _DONE)
+        except _Aborted:
+            pass
+        except BaseException as error:
+            self.errors.append(error)
+            self.failed.set()
+
+
+class _Aborted(Exception):
+    pass
+
+
+def run_pipeline(source, stages, queue_size=8, logger=logging.getLogger(__name__)):
+    # stages are (name, function, number of threads[, flush]), each function maps an item to the next stage's item
+    # (None drops it), or is a generator passing on every item it yields.
+    # flush is called by each thread of the stage at the end and its output passed on the same way.
+    # Returns the outputs of the last stage, raises the first error of any stage.
+    pipeline = _Pipeline(stages, queue_size)
+
+    threads = [threading.Thread(target=pipeline.run_stage, args=(stage,), daemon=True)
+               for stage, stage_spec in enumerate(stages) for _ in range(stage_spec[2])]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    try:
+        for item in source:
+            pipeline.put(0, item)
+
+        for _ in range(stages[0][2]):
+            pipeline.put(0, _DONE)
+    except _Aborted:
+        pass
+    except BaseException:
+        pipeline.failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if len(pipeline.errors) > 0:
+        raise pipeline.errors[0]
+
+    elapsed = time.time() - start
+    logger.info(f'Pipeline finished in {round(elapsed, 1)}s')
+    logger.info(f'  source (calling thread, busy {round(elapsed - pipeline.stats[0].put_wait, 1)}s)')
+    for stage_spec, stats, busy in zip(stages, pipeline.stats, pipeline.busy):
+        logger.info(f'  {stage_spec[0]} ({stage_spec[2]} threads, busy {round(busy, 1)}s) - queue {stats.get_summary()}')
+
+    return pipeline.results
+
+
+## Elasticsearch bulk loading as parse -> encode -> pack -> send
+## Parsing is whatever builds the records (run from the caller's thread), encoding turns small groups of
+## records into bulk lines of bytes (in encoding processes if there are any), packing joins lines into
+## requests of the tuner's size in bytes, sending posts them with as many requests in flight as the tuner allows.
+## Items the cluster rejects for load (429 and the like) are sent again with exponential backoff and jitter.
+## Items that still fail are written to the dead letter file if there is one, and raised otherwise.
+
+RETRY_STATUSES = [429, 502, 503, 504]
+
+# Records per encoding task, requests are packed from their lines whatever the group size
+ENCODE_GROUP_SIZE = 100
+
+
+def _iter_chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+
+def get_backoff(attempt, initial_backoff=1, max_backoff=60):
+    # Half of the exponential delay is fixed and half is random, so retrying senders spread out
+    delay = min(max_backoff, initial_backoff * 2 ** attempt)
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _get_line_size(line):
+    return len(line[0]) + 1 + (0 if line[1] is None else len(line[1]) + 1)
+
+
+def pipelined_bulk(es, records, index_name, tuner=None, encoders=2, encode_pool=None, queue_size=8, max_retries=5, dead_letter_file=None, logger=logging.getLogger(__name__)):
+    tuner = get_tuner(logger=logger) if tuner is None else tuner
+    if encode_pool is None:
+        encode_pool = get_encode_pool()
+        encoders = max(encoders, 2 * get_encode_processes())
+
+    def encode(chunk):
+        if encode_pool is None:
+            return encode_bulk_lines(chunk)
+
+        # The encoding thread only waits for its process, so it doesn't hold the GIL while encoding
+        return encode_pool.submit(encode_bulk_lines, chunk).result()
+
+    # Packing has one thread, so the request being filled needs no lock
+    packing = {'lines': [], 'size': 0}
+
+    def pack(lines):
+        # Line by line, so a request goes out before the next document would take it past the tuner's size.
+        # A document bigger than that on its own is sent alone
+        for line in lines:
+            line_size = _get_line_size(line)
+
+            if len(packing['lines']) > 0 and packing['size'] + line_size > tuner.chunk_bytes:
+                yield flush_pack()
+
+            packing['lines'].append(line)
+            packing['size'] += line_size
+
+    def flush_pack():
+        lines = packing['lines']
+        packing['lines'] = []
+        packing['size'] = 0
+
+        return lines if len(lines) > 0 else None
+
+    def send(lines):
+        pending = list(range(len(lines)))
+        failed = []
+        num_retried = 0
+
+        for attempt in range(max_retries + 1):
+            body = b''.join(lines[position][0] + b'\n' + (b'' if lines[position][1] is None else lines[position][1] + b'\n') for position in pending)
+
+            request_start = tuner.acquire()
+            try:
+                response = es.bulk(body=body, index=index_name)
+            except TransportError as error:
+                # Connection errors have no status code, and are worth a retry too
+                retryable = error.status_code == 'N/A' or error.status_code in RETRY_STATUSES
+                tuner.release(request_start, 0, len(body), len(pending) if retryable else 0)
+
+                if not retryable or attempt == max_retries:
+                    failed.extend((position, {'status': error.status_code, 'error': repr(error)}) for position in pending)
+                    break
+
+                num_retried += len(pending)
+                time.sleep(get_backoff(attempt))
+                continue
+            except BaseException:
+                tuner.release(request_start, 0, len(body), 0)
+                raise
+
+            retry = []
+            for position, item in zip(pending, response['items']):
+                result = next(iter(item.values()))
+                status = result.get('status', 500)
+
+                if 200 <= status < 300:
+                    continue
+
+                if status in RETRY_STATUSES and attempt < max_retries:
+                    retry.append(position)
+                else:
+                    failed.append((position, result))
+
+            tuner.release(request_start, len(pending) - len(retry), len(body), len(retry))
+
+            pending = retry
+            if len(pending) == 0:
+                break
+
+            num_retried += len(pending)
+            time.sleep(get_backoff(attempt))
+
+        dead_letters = [{
+            'index': index_name,
+            'action': json.loads(lines[position][0]),
+            'source': None if lines[position][1] is None else json.loads(lines[position][1]),
+            'error': result
+        } for position, result in failed]
+
+        return len(lines), num_retried, dead_letters, sum(_get_line_size(line) for line in lines)
+
+    # Senders beyond the tuner's concurrency wait for their turn
+    results = run_pipeline(_iter_chunks(records, ENCODE_GROUP_SIZE), [
+        ('encode', encode, encoders),
+        ('pack', pack, 1, flush_pack),
+        ('send', send, tuner.max_concurrency)
+    ], queue_size=queue_size, logger=logger)
+
+    max_request_size = max((request_size for _, _, _, request_size in results), default=0)
+    logger.info(f'{len(results)} bulk requests to {index_name} of up to {round(max_request_size / 1024)} KB, bulk settings now {tuner.get_summary()}')
+
+    num_retried = sum(chunk_retried for _, chunk_retried, _, _ in results)
+    if num_retried > 0:
+        logger.info(f'{num_retried} documents were sent again after the cluster rejected them')
+
+    dead_letters = [dead_letter for _, _, chunk_dead_letters, _ in results for dead_letter in chunk_dead_letters]
+    if len(dead_letters) > 0:
+        for dead_letter in dead_letters[:10]:
+            logger.info(dead_letter['error'])
+
+        if dead_letter_file is None:
+            raise helpers.BulkIndexError(f'{len(dead_letters)} document(s) failed to index.', [dead_letter['error'] for dead_letter in dead_letters])
+
+        write_dead_letters(dead_letter_file, dead_letters)
+        logger.warning(f'{len(dead_letters)} documents failed to index, written to {dead_letter_file}')
+
+    return sum(num_records for num_records, _, _, _ in results) - len(dead_letters)
@@ -0,0 +1,70 @@
+import logging
+import re
+import time
+
+
+## Versioned indices behind a stable alias
+## A reload writes <alias>_v<version> indices while the alias keeps serving the previous version,
+## then repoints the alias in a single update_aliases call once the load is checked.
+## The live version and the ones just before it are kept to go back to, older ones are deleted.
+## Versions newer than the live one are loads still running (or killed), and are left alone.
+
+def get_new_version():
+    return time.strftime('%Y%m%d%H%M%S')
+
+
+def get_version_index(alias, version):
+    return alias if version is None else f'{alias}_v{version}'
+
+
+def get_versions(es, alias):
+    # Version indices of alias, oldest first
+    pattern = re.compile(re.escape(alias) + r'_v\d{14}$')
+
+    return sorted(index for index in es.indices.get(index=f'{alias}_v*') if pattern.match(index))
+
+
+def get_alias_indices(es, alias):
+    if not es.indices.exists_alias(name=alias):
+        return []
+
+    return list(es.indices.get_alias(name=alias))
+
+
+def swap_alias(es, alias, index, filter=None, logger=logging.getLogger(__name__)):
+    add = {"index": index, "alias": alias}
+    if filter is not None:
+        add["filter"] = filter
+
+    actions = [{"remove": {"index": current, "alias": alias}} for current in get_alias_indices(es, alias)]
+
+    if len(actions) == 0 and es.indices.exists(alias):
+        # An index loaded before versioned loads is deleted in the same update
+        logger.info(f'Replacing index {alias} with an alias')
+        actions.append({"remove_index": {"index": alias}})
+
+    es.indices.update_aliases(body={"actions": actions + [{"add": add}]})
+
+
+def remove_old_versions(es, alias, keep_versions, logger=logging.getLogger(__name__)):
+    versions = get_versions(es, alias)
+    live = [index for index in versions if index in get_alias_indices(es, alias)]
+
+    if len(live) == 0:
+        return
+
+    position = versions.index(live[-1])
+
+    for index in versions[:max(position - keep_versions + 1, 0)]:
+        logger.info(f'Deleting old version {index}')
+        es.indices.delete(index=index, ignore=[400, 404])
+
+
+def delete_versions(es, alias, logger=logging.getLogger(__name__)):
+    # The alias and every version of it
+    if es.indices.exists_alias(name=alias):
+        es.indices.delete_alias(index='_all', name=alias)
+
+    for index in get_versions(es, alias):
+        logger.info(f'Deleting version {index}')
+        es.indices.delete(index=index, ignore=[400, 404])